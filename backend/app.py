@@ -1,47 +1,91 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, current_app, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import os
 from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 import secrets
 import uuid
 import random
 import string
+from types import SimpleNamespace
+from urllib.parse import quote
 from werkzeug.security import generate_password_hash, check_password_hash
-import requests
 import logging
+from contextlib import ExitStack
+import click
+from flask.cli import AppGroup
+from sqlalchemy import UniqueConstraint, case, insert, inspect, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.schema import CreateTable
+from json_provider import FastJSONProvider
+from idempotency import Idempotency
+import sharding
+import dataio
+import readwrite
+import escrow_states
+from readwrite import read_only
 # Remove the TON Client import and replace with a mock implementation
 # from tonclient.client import TonClient
 # from tonclient.types import ParamsOfQueryCollection, NetworkConfig
 
-app = Flask(__name__)
-CORS(app)
+db = SQLAlchemy(session_options={'class_': readwrite.ReadWriteSession})
+cors = CORS()
+idempotency = Idempotency()
+# Routes and CLI commands, registered on the app by create_app()
+api = Blueprint('api', __name__, cli_group=None)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-app.logger.setLevel(logging.INFO)
+def load_config(app):
+    # Configure SQLite database
+    basedir = os.path.abspath(os.path.dirname(__file__))
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'mining_app.db')
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Write transactions open with BEGIN IMMEDIATE at their first write, so
+    # SQLite runs them one at a time across threads and workers, and a
+    # writer waits up to SQLITE_BUSY_TIMEOUT seconds for its turn. Requests
+    # that only read, or are waiting on something else, hold no lock.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'connect_args': {
+            'isolation_level': 'IMMEDIATE',
+            'timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 10))
+        }
+    }
+    # Read-only connections per database for GET views, 0 reads through the writer
+    app.config['READ_POOL_SIZE'] = int(os.environ.get('READ_POOL_SIZE', 4))
+    app.config['SECRET_KEY'] = secrets.token_hex(16)
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+    # Finished escrows older than this are moved to the archive table
+    app.config['ESCROW_ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ESCROW_ARCHIVE_AFTER_DAYS', 30))
+    # Delivered outbox messages and inbox entries older than this are purged,
+    # must exceed the longest the relay may fall behind
+    app.config['OUTBOX_RETENTION_DAYS'] = int(os.environ.get('OUTBOX_RETENTION_DAYS', 7))
+    # Path to a shard map file, see sharding.py. Unset means a single database.
+    app.config['SHARD_MAP'] = os.environ.get('SHARD_MAP')
+    # Admin endpoints are disabled unless a token is configured
+    app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+    app.config['ANALYTICS_CACHE_TTL'] = int(os.environ.get('ANALYTICS_CACHE_TTL', 300))
 
-# Configure SQLite database
-basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'mining_app.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = secrets.token_hex(16)
+def get_shard_router():
+    """The current app's ShardRouter, or None without sharding"""
+    return current_app.extensions['shard_router']
 
-db = SQLAlchemy(app)
 # Replace the TON client with a mock
 # ton_client = TonClient(network=NetworkConfig(server_address='https://mainnet.tonhubapi.com'))
 
 # Updated Models based on the new schema
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    telegram_id = db.Column(db.String(50), unique=True, nullable=False)
+    telegram_id = db.Column(db.String(50), unique=True, index=True, nullable=False)
     username = db.Column(db.String(50), nullable=False)
     points_mined = db.Column(db.Integer, default=0)
     last_mine_time = db.Column(db.DateTime, default=datetime.utcnow)
     node_status = db.Column(db.String(10), default='off')
     node_expiry_time = db.Column(db.DateTime, nullable=True)
     wallet_address = db.Column(db.String(100), nullable=True)
-    referral_code = db.Column(db.String(10), unique=True, nullable=True)
+    referral_code = db.Column(db.String(10), unique=True, index=True, nullable=True)
     referrer_id = db.Column(db.Integer, nullable=True)
     
     # Relationships
@@ -56,9 +100,9 @@ class User(db.Model):
             'telegram_id': self.telegram_id,
             'username': self.username,
             'points_mined': self.points_mined,
-            'last_mine_time': self.last_mine_time.isoformat() if self.last_mine_time else None,
+            'last_mine_time': self.last_mine_time,
             'node_status': self.node_status,
-            'node_expiry_time': self.node_expiry_time.isoformat() if self.node_expiry_time else None,
+            'node_expiry_time': self.node_expiry_time,
             'wallet_address': self.wallet_address,
             'referral_code': self.referral_code,
             'referrer_id': self.referrer_id
@@ -72,12 +116,7 @@ class PointCard(db.Model):
     purchase_time = db.Column(db.DateTime, default=datetime.utcnow)
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'card_type': self.card_type,
-            'fees_remaining': self.fees_remaining,
-            'purchase_time': self.purchase_time.isoformat()
-        }
+        return serialize_point_card(self)
 
 class Upgrade(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -86,59 +125,331 @@ class Upgrade(db.Model):
     expiry_time = db.Column(db.DateTime, nullable=False)
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'upgrade_type': self.upgrade_type,
-            'expiry_time': self.expiry_time.isoformat(),
-            'is_active': self.expiry_time > datetime.utcnow()
-        }
+        return serialize_upgrade(self)
 
 class Escrow(db.Model):
+    # Never hand out an id again once its escrow has been archived, rows
+    # keep their id in `escrow_archive` and history pages by it
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id = db.Column(db.Integer, primary_key=True)
-    escrow_id = db.Column(db.String(50), unique=True, nullable=False)
+    escrow_id = db.Column(db.String(50), unique=True, index=True, nullable=False)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     sender_wallet_address = db.Column(db.String(100), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_wallet_address = db.Column(db.String(100), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     fee_amount = db.Column(db.Float, nullable=False)
+    amount_nanotons = db.Column(db.BigInteger, nullable=True)  # Exact amount, 1 TON = 10^9 nanotons
+    fee_nanotons = db.Column(db.BigInteger, nullable=True)
     status = db.Column(db.String(20), default='pending')  # pending, active, completed, cancelled, pending_cancel
     creation_time = db.Column(db.DateTime, default=datetime.utcnow)
     lock_period = db.Column(db.Integer, nullable=False)
     unlock_time = db.Column(db.DateTime, nullable=False)
     pin_hash = db.Column(db.String(200), nullable=False)
     card_used = db.Column(db.Boolean, default=False)
-    cancel_status = db.Column(db.String(20), nullable=True)  # null, sender_requested, receiver_requested
+    cancel_status = db.Column(db.String(20), nullable=True)  # null, sender_requested, receiver_requested, mutual, admin
     requested_by = db.Column(db.Integer, nullable=True)  # Store ID of user who requested cancellation
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'escrow_id': self.escrow_id,
-            'sender_username': User.query.get(self.sender_id).username,
-            'receiver_username': User.query.get(self.receiver_id).username,
-            'amount': self.amount,
-            'fee_amount': self.fee_amount,
-            'status': self.status,
-            'creation_time': self.creation_time.isoformat(),
-            'lock_period': self.lock_period,
-            'unlock_time': self.unlock_time.isoformat(),
-            'card_used': self.card_used,
-            'can_withdraw': datetime.utcnow() >= self.unlock_time and self.status == 'active',
-            'cancel_status': self.cancel_status,
-            'requested_by': self.requested_by
-        }
+        # Looked up by id rather than through the relationships, which can't
+        # follow a receiver living on another shard
+        sender = db.session.get(User, self.sender_id)
+        receiver = db.session.get(User, self.receiver_id)
+        return serialize_escrow(self, sender.username, receiver.username)
+
+class EscrowArchive(db.Model):
+    """Completed and cancelled escrows moved out of the hot `escrow` table"""
+    __tablename__ = 'escrow_archive'
+
+    id = db.Column(db.Integer, primary_key=True)  # Same id the row had in `escrow`
+    escrow_id = db.Column(db.String(50), unique=True, index=True, nullable=False)
+    sender_id = db.Column(db.Integer, nullable=False, index=True)
+    sender_wallet_address = db.Column(db.String(100), nullable=False)
+    receiver_id = db.Column(db.Integer, nullable=False, index=True)
+    receiver_wallet_address = db.Column(db.String(100), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    fee_amount = db.Column(db.Float, nullable=False)
+    amount_nanotons = db.Column(db.BigInteger, nullable=True)  # Exact amount, 1 TON = 10^9 nanotons
+    fee_nanotons = db.Column(db.BigInteger, nullable=True)
+    status = db.Column(db.String(20), nullable=False)  # completed, cancelled
+    creation_time = db.Column(db.DateTime, nullable=False)
+    lock_period = db.Column(db.Integer, nullable=False)
+    unlock_time = db.Column(db.DateTime, nullable=False)
+    card_used = db.Column(db.Boolean, default=False)
+    cancel_status = db.Column(db.String(20), nullable=True)
+    requested_by = db.Column(db.Integer, nullable=True)
+    archived_time = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ShardOutbox(db.Model):
+    """Effects on another user's data, delivered by `deliver_outbox`"""
+    __tablename__ = 'shard_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.String(32), unique=True, index=True, nullable=False, default=lambda: uuid.uuid4().hex)
+    slot = db.Column(db.Integer, nullable=False)  # Slot of the user whose change produced the message
+    target_id = db.Column(db.Integer, nullable=False)  # User the effect applies to
+    kind = db.Column(db.String(20), nullable=False)  # referral_bonus
+    points = db.Column(db.Integer, nullable=True)
+    created_time = db.Column(db.DateTime, default=datetime.utcnow)
+    delivered_time = db.Column(db.DateTime, nullable=True, index=True)
+
+class ShardInbox(db.Model):
+    """Outbox messages already applied to their target user"""
+    __tablename__ = 'shard_inbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.String(32), unique=True, index=True, nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    received_time = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Release, withdraw and cancel run as compare-and-set updates, see escrow_states.py
+escrow_transitions = escrow_states.EscrowTransitions(Escrow)
+
+# Serializers shared by the models and the column projections below. They
+# accept anything with the right attributes, so list endpoints can pass plain
+# result rows instead of hydrating full ORM objects.
+def serialize_point_card(card):
+    return {
+        'id': card.id,
+        'card_type': card.card_type,
+        'fees_remaining': card.fees_remaining,
+        'purchase_time': card.purchase_time
+    }
+
+def serialize_upgrade(upgrade, now=None):
+    now = now or datetime.utcnow()
+    return {
+        'id': upgrade.id,
+        'upgrade_type': upgrade.upgrade_type,
+        'expiry_time': upgrade.expiry_time,
+        'is_active': upgrade.expiry_time > now
+    }
+
+def serialize_escrow(escrow, sender_username, receiver_username, now=None):
+    now = now or datetime.utcnow()
+    return {
+        'id': escrow.id,
+        'escrow_id': escrow.escrow_id,
+        'sender_username': sender_username,
+        'receiver_username': receiver_username,
+        'amount': escrow.amount,
+        'fee_amount': escrow.fee_amount,
+        'status': escrow.status,
+        'creation_time': escrow.creation_time,
+        'lock_period': escrow.lock_period,
+        'unlock_time': escrow.unlock_time,
+        'card_used': escrow.card_used,
+        'can_withdraw': now >= escrow.unlock_time and escrow.status == 'active',
+        'cancel_status': escrow.cancel_status,
+        'requested_by': escrow.requested_by
+    }
+
+# Column projections
+POINT_CARD_COLUMNS = (PointCard.id, PointCard.card_type, PointCard.fees_remaining, PointCard.purchase_time)
+UPGRADE_COLUMNS = (Upgrade.id, Upgrade.upgrade_type, Upgrade.expiry_time)
+ESCROW_COLUMN_NAMES = (
+    'id', 'escrow_id', 'amount', 'fee_amount', 'status', 'creation_time',
+    'lock_period', 'unlock_time', 'card_used', 'cancel_status', 'requested_by'
+)
+
+def project_escrows(*criteria, order_by=(), limit=None, model=Escrow):
+    """
+    Fetch escrow rows with both usernames joined in, in a single query.
+    Pass `model=EscrowArchive` to read archived escrows instead.
+    """
+    sender = aliased(User)
+    receiver = aliased(User)
+    rows = db.session.query(
+        *(getattr(model, name) for name in ESCROW_COLUMN_NAMES),
+        model.sender_id,
+        model.receiver_id,
+        sender.username.label('sender_username'),
+        receiver.username.label('receiver_username')
+    ).outerjoin(sender, sender.id == model.sender_id) \
+     .outerjoin(receiver, receiver.id == model.receiver_id) \
+     .filter(*criteria) \
+     .order_by(*order_by) \
+     .limit(limit) \
+     .all()
+    
+    # With sharding, the receiver may live on another shard than the escrow
+    missing = {row.receiver_id for row in rows if row.receiver_username is None} | \
+              {row.sender_id for row in rows if row.sender_username is None}
+    if not missing:
+        return rows
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(missing)).all())
+    return [
+        SimpleNamespace(**{
+            **row._asdict(),
+            'sender_username': row.sender_username or usernames.get(row.sender_id),
+            'receiver_username': row.receiver_username or usernames.get(row.receiver_id)
+        }) if row.sender_username is None or row.receiver_username is None else row
+        for row in rows
+    ]
+
+@api.before_app_request
+def refresh_shard_map():
+    shard_router = get_shard_router()
+    if shard_router:
+        shard_router.refresh()
+
+@api.app_errorhandler(IntegrityError)
+def retry_fenced_write(error):
+    # A write that reached a shard after move_slots took its slot away.
+    # Nothing was written, the retry is routed with the new shard map.
+    if not sharding.is_fenced(error):
+        raise error
+    db.session.rollback()
+    response = jsonify({'error': 'This data is being moved, please retry'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Columns added after their table was first created. db.create_all() does not
+# alter existing tables, so they are added and backfilled here.
+ADDED_COLUMNS = {
+    'escrow': (
+        ('amount_nanotons', 'BIGINT', 'CAST(round(amount * 1000000000) AS INTEGER)'),
+        ('fee_nanotons', 'BIGINT', 'CAST(round(fee_amount * 1000000000) AS INTEGER)'),
+    ),
+    'escrow_archive': (
+        ('amount_nanotons', 'BIGINT', 'CAST(round(amount * 1000000000) AS INTEGER)'),
+        ('fee_nanotons', 'BIGINT', 'CAST(round(fee_amount * 1000000000) AS INTEGER)'),
+    ),
+    'shard_inbox': (
+        ('received_time', 'DATETIME', "datetime('now')"),
+    ),
+}
+
+def rebuild_table(conn, table):
+    """
+    Recreate `table` from its model, keeping its rows and triggers. SQLite
+    can't change a table's constraints in place, so this follows the steps
+    in https://www.sqlite.org/lang_altertable.html#otheralter
+    """
+    triggers = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table.name,)
+    ).scalars().all()
+    preparer = conn.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    rebuilt = preparer.quote(f'{table.name}__rebuild')
+    ddl = str(CreateTable(table).compile(dialect=conn.dialect))
+    conn.exec_driver_sql(ddl.replace(f'CREATE TABLE {name} ', f'CREATE TABLE {rebuilt} ', 1))
+    existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+    columns = ', '.join(preparer.quote(column.name) for column in table.columns if column.name in existing)
+    conn.exec_driver_sql(f'INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {name}')
+    conn.exec_driver_sql(f'DROP TABLE {name}')
+    conn.exec_driver_sql(f'ALTER TABLE {rebuilt} RENAME TO {name}')
+    for index in table.indexes:
+        index.create(conn)
+    for trigger in triggers:
+        conn.exec_driver_sql(trigger)
+
+def is_outdated(conn, table):
+    """
+    True when the table on disk lacks AUTOINCREMENT its model asks for, or
+    still has inline UNIQUE constraints where the model declares named
+    unique indexes
+    """
+    ddl = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+    ).scalar()
+    if table.dialect_options['sqlite']['autoincrement'] and 'AUTOINCREMENT' not in ddl.upper():
+        return True
+    if any(isinstance(constraint, UniqueConstraint) for constraint in table.constraints):
+        return False
+    return conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name LIKE 'sqlite_autoindex_%'",
+        (table.name,)
+    ).first() is not None
+
+def reserve_archived_ids(conn):
+    """
+    Keep escrow ids unique across `escrow` and `escrow_archive`. Escrows
+    created before `escrow` used AUTOINCREMENT may have been handed the id
+    of an archived one, those get a new id, and the sequence is moved past
+    every archived id.
+    """
+    top = conn.exec_driver_sql(
+        'SELECT max(coalesce((SELECT max(id) FROM escrow), 0), coalesce((SELECT max(id) FROM escrow_archive), 0))'
+    ).scalar()
+    reused = conn.exec_driver_sql(
+        'SELECT id FROM escrow WHERE id IN (SELECT id FROM escrow_archive) ORDER BY id'
+    ).scalars().all()
+    for old_id in reused:
+        # Keeps the slot in the low bits, so the row stays on its shard
+        top = (top // sharding.SLOT_COUNT + 1) * sharding.SLOT_COUNT + old_id % sharding.SLOT_COUNT
+        conn.exec_driver_sql('UPDATE escrow SET id = ? WHERE id = ?', (top, old_id))
+    if reused:
+        current_app.logger.warning("Gave %d escrows sharing an archived escrow's id a new id", len(reused))
+    conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'escrow'")
+    conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES ('escrow', ?)", (top,))
 
-# Create database tables
-with app.app_context():
-    db.create_all()
+def upgrade_schema(engine):
+    with engine.begin() as conn:
+        # One transaction for the whole upgrade, pysqlite would run DDL outside of one
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {column['name'] for column in inspect(conn).get_columns(table)}
+            for name, ddl, backfill in columns:
+                if name not in existing:
+                    conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}')
+                    conn.exec_driver_sql(f'UPDATE {table} SET {name} = {backfill}')
+        for table in db.metadata.sorted_tables:
+            if inspect(conn).has_table(table.name) and is_outdated(conn, table):
+                rebuild_table(conn, table)
+            # create_all skips existing tables, so an index lost since, e.g.
+            # to an interrupted import, is only recreated here
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        reserve_archived_ids(conn)
+
+def schema_is_current(engine):
+    """True when every table and added column exists, as after `flask init-db`"""
+    inspector = inspect(engine)
+    if not all(inspector.has_table(table.name) for table in db.metadata.sorted_tables):
+        return False
+    return all(
+        name in {column['name'] for column in inspector.get_columns(table)}
+        for table, columns in ADDED_COLUMNS.items() for name, _, _ in columns
+    )
+
+def database_engines():
+    """The engine of each shard, or the single engine without sharding"""
+    shard_router = get_shard_router()
+    if not shard_router:
+        return {None: db.engine}
+    return dict(shard_router.engines)
+
+def shard_execution_options():
+    """Execution options that pin a query to each shard in turn"""
+    shard_router = get_shard_router()
+    if not shard_router:
+        return [{}]
+    return [{'_sa_shard_id': shard_id} for shard_id in shard_router.shard_ids]
+
+def create_schema():
+    """Create missing tables and columns on every database, safe to run again"""
+    shard_router = get_shard_router()
+    if shard_router:
+        shard_router.create_all(db.metadata)
+    else:
+        db.create_all()
+    for engine in database_engines().values():
+        upgrade_schema(engine)
+        # Lets the read-only connections read while a write is in progress
+        readwrite.enable_wal(engine)
+    # Shared by every worker, so a retried request is answered once
+    current_app.extensions['idempotency'].create_table()
 
 # Mock implementation of TON balance check
 def validate_ton_transaction(wallet_address, amount):
+    import requests  # Only needed by escrow creation, kept out of startup
+    
     try:
         # Make a real API call to TON Center to get the wallet balance
         api_url = f"https://toncenter.com/api/v2/getAddressBalance?address={wallet_address}"
-        response = requests.get(api_url)
+        response = requests.get(api_url, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -160,6 +471,24 @@ def validate_ton_transaction(wallet_address, amount):
         return False
 
 # Helper Functions
+NANOTONS_PER_TON = 10 ** 9
+# Largest amount the BIGINT nanoton columns hold
+MAX_NANOTONS = 2 ** 63 - 1
+
+def to_nanotons(amount):
+    """
+    Convert a TON amount from a request to an exact integer of nanotons.
+    Raises ValueError for amounts that are not finite, not positive or too
+    large to store.
+    """
+    value = Decimal(str(amount))
+    if not value.is_finite():
+        raise ValueError(f"Amount {amount!r} is not a number")
+    nanotons = int((value * NANOTONS_PER_TON).to_integral_value(rounding=ROUND_HALF_UP))
+    if not 0 < nanotons <= MAX_NANOTONS:
+        raise ValueError(f"Amount {amount!r} is out of range")
+    return nanotons
+
 def get_user_by_telegram_id(telegram_id):
     return User.query.filter_by(telegram_id=telegram_id).first()
 
@@ -184,6 +513,73 @@ def has_active_upgrade(user_id, upgrade_type):
     ).filter(Upgrade.expiry_time > datetime.utcnow()).first()
     return upgrade is not None
 
+FINISHED_ESCROW_STATUSES = escrow_states.FINISHED
+
+def archive_escrows(older_than_days=None, batch_size=500):
+    """
+    Move finished escrows created more than `older_than_days` ago from the
+    hot `escrow` table into `escrow_archive`.
+
+    Rows are copied and deleted in batches of `batch_size`, one transaction
+    per batch, walking the primary key so each batch starts where the last
+    one stopped. Returns the number of escrows archived.
+    """
+    if older_than_days is None:
+        older_than_days = current_app.config['ESCROW_ARCHIVE_AFTER_DAYS']
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    columns = [column.name for column in EscrowArchive.__table__.columns if column.name != 'archived_time']
+
+    archived = 0
+    for options in shard_execution_options():
+        last_id = 0
+        while True:
+            ids = [row.id for row in db.session.query(Escrow.id).execution_options(**options).filter(
+                Escrow.id > last_id,
+                Escrow.status.in_(FINISHED_ESCROW_STATUSES),
+                Escrow.creation_time < cutoff
+            ).order_by(Escrow.id).limit(batch_size)]
+            if not ids:
+                break
+
+            db.session.execute(insert(EscrowArchive).from_select(
+                columns,
+                select(*(getattr(Escrow, name) for name in columns)).where(Escrow.id.in_(ids))
+            ), execution_options=options)
+            Escrow.query.execution_options(**options).filter(Escrow.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+
+            archived += len(ids)
+            last_id = ids[-1]
+    return archived
+
+def apply_referral_bonus(session, message):
+    referrer = session.get(User, message.target_id)
+    if referrer:
+        referrer.points_mined += message.points
+
+OUTBOX_HANDLERS = {
+    'referral_bonus': apply_referral_bonus
+}
+
+def deliver_outbox(limit=100):
+    """Apply pending cross-user effects, see sharding.deliver_outbox"""
+    return sharding.deliver_outbox(
+        db, ShardOutbox, ShardInbox, OUTBOX_HANDLERS, shard_execution_options(), limit
+    )
+
+def deliver_message(message):
+    """Apply one cross-user effect right away, see sharding.deliver_message"""
+    sharding.deliver_message(db, ShardInbox, OUTBOX_HANDLERS, message)
+
+def purge_outbox(older_than_days=None):
+    """Delete delivered outbox messages and inbox entries older than the retention"""
+    if older_than_days is None:
+        older_than_days = current_app.config['OUTBOX_RETENTION_DAYS']
+    return sharding.purge_outbox(
+        database_engines().values(), ShardOutbox.__table__, ShardInbox.__table__,
+        datetime.utcnow() - timedelta(days=older_than_days)
+    )
+
 def verify_telegram_data(init_data):
     """
     Validates Telegram WebApp initData and extracts user information.
@@ -219,19 +615,19 @@ def verify_telegram_data(init_data):
 
 # API Routes
 # Authentication Endpoints
-@app.route('/api/auth/check_and_create_user', methods=['POST'])
+@api.route('/api/auth/check_and_create_user', methods=['POST'])
 def check_and_create_user():
     data = request.json
-    app.logger.info(f"Received request to check/create user: {data}")
+    current_app.logger.info(f"Received request to check/create user: {data}")
     
     # Log the entire request data
-    app.logger.info(f"Full request data: {request.data}")
+    current_app.logger.info(f"Full request data: {request.data}")
     
     # Log headers to check for any Telegram-specific information
-    app.logger.info(f"Request headers: {request.headers}")
+    current_app.logger.info(f"Request headers: {request.headers}")
     
     if not data:
-        app.logger.error("No data provided in request")
+        current_app.logger.error("No data provided in request")
         return jsonify({'error': 'No data provided'}), 400
     
     # Handle both direct user_id and Telegram initData formats
@@ -243,7 +639,7 @@ def check_and_create_user():
         # This is coming from Telegram Mini App
         telegram_data = verify_telegram_data(data.get('initData'))
         if not telegram_data or 'id' not in telegram_data:
-            app.logger.error("Invalid Telegram data")
+            current_app.logger.error("Invalid Telegram data")
             return jsonify({'error': 'Invalid Telegram data'}), 400
         
         telegram_id = telegram_data['id']
@@ -251,7 +647,7 @@ def check_and_create_user():
         
         # Extract start parameter from initData if available
         start_param = data.get('start_param')
-        app.logger.info(f"Start parameter from Telegram: {start_param}")
+        current_app.logger.info(f"Start parameter from Telegram: {start_param}")
         if start_param:
             referral_code = start_param
     else:
@@ -261,19 +657,19 @@ def check_and_create_user():
         referral_code = data.get('referral_code')
         
         if not telegram_id or not username:
-            app.logger.error("Missing required user data")
+            current_app.logger.error("Missing required user data")
             return jsonify({'error': 'Missing required user data'}), 400
     
-    app.logger.info(f"Looking up user with telegram_id: {telegram_id}")
+    current_app.logger.info(f"Looking up user with telegram_id: {telegram_id}")
     user = get_user_by_telegram_id(telegram_id)
     
     if not user:
-        app.logger.info(f"User {telegram_id} not found, creating new user")
+        current_app.logger.info(f"User {telegram_id} not found, creating new user")
         # Check for referrer if referral code provided
         referrer = None
         if referral_code:
             referrer = get_user_by_referral_code(referral_code)
-            app.logger.info(f"Found referrer: {referrer.username if referrer else 'None'}")
+            current_app.logger.info(f"Found referrer: {referrer.username if referrer else 'None'}")
         
         # Create a new user with referral code
         user = User(
@@ -285,34 +681,53 @@ def check_and_create_user():
         
         db.session.add(user)
         
+        # Award 50 bonus points to referrer. The referrer may be on another
+        # shard, so the bonus is queued in the new user's transaction and
+        # delivered right after it commits.
+        bonus = None
+        if referrer:
+            bonus = ShardOutbox(
+                slot=sharding.slot_for_key(telegram_id),
+                target_id=referrer.id,
+                kind='referral_bonus',
+                points=50
+            )
+            db.session.add(bonus)
+        
         try:
             db.session.commit()
-            app.logger.info(f"Created new user: {user.username} with referral code: {user.referral_code}")
-            
-            # If there was a referrer, could award bonus points here
-            if referrer:
-                # Award 50 bonus points to referrer
-                referrer.points_mined += 50
-                db.session.commit()
-                app.logger.info(f"Awarded 50 bonus points to referrer {referrer.username}")
+            current_app.logger.info(f"Created new user: {user.username} with referral code: {user.referral_code}")
         except Exception as e:
-            app.logger.error(f"Error creating user: {str(e)}")
             db.session.rollback()
+            if sharding.is_fenced(e):
+                raise  # Answered with 503 by retry_fenced_write
+            current_app.logger.error(f"Error creating user: {str(e)}")
             return jsonify({'error': 'Failed to create user'}), 500
+        
+        if bonus:
+            try:
+                # Only this signup's own bonus, any backlog is left to `flask shards relay`
+                deliver_message(bonus)
+                current_app.logger.info(f"Awarded 50 bonus points to referrer {referrer.username}")
+            except Exception as e:
+                # The bonus stays in the outbox for `flask shards relay`
+                current_app.logger.error(f"Error delivering referral bonus: {str(e)}")
+                db.session.rollback()
     else:
-        app.logger.info(f"Found existing user: {user.username}")
+        current_app.logger.info(f"Found existing user: {user.username}")
     
     response_data = user.to_dict()
-    app.logger.info(f"Sending response: {response_data}")
+    current_app.logger.info(f"Sending response: {response_data}")
     
     return jsonify(response_data), 200
 
 # Keep the original login endpoint for backward compatibility
-@app.route('/api/auth/login', methods=['POST'])
+@api.route('/api/auth/login', methods=['POST'])
 def login():
     return check_and_create_user()
 
-@app.route('/api/auth/get_user', methods=['GET'])
+@api.route('/api/auth/get_user', methods=['GET'])
+@read_only(max_staleness=5)
 def get_user():
     telegram_id = request.args.get('telegram_id')
     if not telegram_id:
@@ -324,26 +739,29 @@ def get_user():
         
     return jsonify(user.to_dict()), 200
 
-@app.route('/api/auth/get_referrals', methods=['GET'])
+@api.route('/api/auth/get_referrals', methods=['GET'])
+@read_only(max_staleness=30)
 def get_referrals():
     telegram_id = request.args.get('telegram_id')
     if not telegram_id:
-        app.logger.error("Missing telegram_id in request")
+        current_app.logger.error("Missing telegram_id in request")
         return jsonify({'error': 'Missing telegram_id'}), 400
         
     user = get_user_by_telegram_id(telegram_id)
     if not user:
-        app.logger.error(f"User with telegram_id {telegram_id} not found")
+        current_app.logger.error(f"User with telegram_id {telegram_id} not found")
         return jsonify({'error': 'User not found'}), 404
     
     if not user.referral_code:
-        app.logger.info(f"User {user.username} has no referral code, generating one")
+        current_app.logger.info(f"User {user.username} has no referral code, generating one")
         user.referral_code = generate_referral_code()
         db.session.commit()
     
     # Find all users who have this user as their referrer
-    referred_users = User.query.filter_by(referrer_id=user.id).all()
-    app.logger.info(f"Found {len(referred_users)} users referred by {user.username}")
+    referred_users = db.session.query(
+        User.username, User.points_mined, User.last_mine_time
+    ).filter(User.referrer_id == user.id).all()
+    current_app.logger.info(f"Found {len(referred_users)} users referred by {user.username}")
     
     return jsonify({
         'referral_code': user.referral_code,
@@ -353,14 +771,14 @@ def get_referrals():
             {
                 'username': referred.username,
                 'points_mined': referred.points_mined,
-                'joined_date': referred.last_mine_time.isoformat()
+                'joined_date': referred.last_mine_time
             } for referred in referred_users
         ],
         'bonus_points': len(referred_users) * 50  # 50 points per referral
     }), 200
 
 # Game Endpoints
-@app.route('/api/game/start_node', methods=['POST'])
+@api.route('/api/game/start_node', methods=['POST'])
 def start_node():
     data = request.json
     if not data or 'telegram_id' not in data:
@@ -386,11 +804,11 @@ def start_node():
     return jsonify({
         'status': 'success',
         'node_status': 'on',
-        'expiry_time': user.node_expiry_time.isoformat(),
+        'expiry_time': user.node_expiry_time,
         'remaining_time': (user.node_expiry_time - datetime.utcnow()).total_seconds()
     }), 200
 
-@app.route('/api/game/check_status', methods=['GET'])
+@api.route('/api/game/check_status', methods=['GET'])
 def check_status():
     telegram_id = request.args.get('telegram_id')
     if not telegram_id:
@@ -439,7 +857,7 @@ def check_status():
         return jsonify({
             'status': 'restarted',
             'node_status': 'on',
-            'expiry_time': user.node_expiry_time.isoformat(),
+            'expiry_time': user.node_expiry_time,
             'remaining_time': (user.node_expiry_time - now).total_seconds()
         }), 200
     
@@ -450,7 +868,7 @@ def check_status():
         'total_points': user.points_mined
     }), 200
 
-@app.route('/api/game/claim', methods=['POST'])
+@api.route('/api/game/claim', methods=['POST'])
 def claim_points():
     data = request.json
     if not data or 'telegram_id' not in data:
@@ -477,7 +895,8 @@ def claim_points():
         'total_points': user.points_mined
     }), 200
 
-@app.route('/api/game/stats', methods=['GET'])
+@api.route('/api/game/stats', methods=['GET'])
+@read_only(max_staleness=5)
 def get_stats():
     telegram_id = request.args.get('telegram_id')
     if not telegram_id:
@@ -491,11 +910,11 @@ def get_stats():
     # For this demo, we'll just return the total points
     return jsonify({
         'total_points': user.points_mined,
-        'last_mine_time': user.last_mine_time.isoformat() if user.last_mine_time else None
+        'last_mine_time': user.last_mine_time
     }), 200
 
 # Shop Endpoints
-@app.route('/api/shop/buy_upgrade', methods=['POST'])
+@api.route('/api/shop/buy_upgrade', methods=['POST'])
 def buy_upgrade():
     data = request.json
     if not data or 'telegram_id' not in data or 'upgrade_type' not in data:
@@ -536,7 +955,7 @@ def buy_upgrade():
         'upgrade': upgrade.to_dict()
     }), 201
 
-@app.route('/api/shop/buy_card', methods=['POST'])
+@api.route('/api/shop/buy_card', methods=['POST'])
 def buy_card():
     data = request.json
     if not data or 'telegram_id' not in data or 'card_type' not in data:
@@ -589,7 +1008,8 @@ def buy_card():
         'card': card.to_dict()
     }), 201
 
-@app.route('/api/shop/inventory', methods=['GET'])
+@api.route('/api/shop/inventory', methods=['GET'])
+@read_only(max_staleness=5)
 def get_inventory():
     telegram_id = request.args.get('telegram_id')
     if not telegram_id:
@@ -601,18 +1021,20 @@ def get_inventory():
         
     # Get active upgrades
     now = datetime.utcnow()
-    active_upgrades = Upgrade.query.filter_by(user_id=user.id).filter(Upgrade.expiry_time > now).all()
+    active_upgrades = db.session.query(*UPGRADE_COLUMNS) \
+        .filter(Upgrade.user_id == user.id, Upgrade.expiry_time > now).all()
     
     # Get point cards with remaining uses
-    point_cards = PointCard.query.filter_by(user_id=user.id).filter(PointCard.fees_remaining > 0).all()
+    point_cards = db.session.query(*POINT_CARD_COLUMNS) \
+        .filter(PointCard.user_id == user.id, PointCard.fees_remaining > 0).all()
     
     return jsonify({
-        'upgrades': [upgrade.to_dict() for upgrade in active_upgrades],
-        'point_cards': [card.to_dict() for card in point_cards]
+        'upgrades': [serialize_upgrade(upgrade, now) for upgrade in active_upgrades],
+        'point_cards': [serialize_point_card(card) for card in point_cards]
     }), 200
 
 # Escrow Endpoints
-@app.route('/api/escrow/create', methods=['POST'])
+@api.route('/api/escrow/create', methods=['POST'])
 def create_escrow():
     data = request.json
     required_fields = ['sender_telegram_id', 'receiver_username', 'amount', 'lock_period', 'pin']
@@ -636,12 +1058,17 @@ def create_escrow():
     if not receiver.wallet_address:
         return jsonify({'error': 'Receiver wallet not connected'}), 400
         
-    amount = float(data['amount'])
+    try:
+        amount_nanotons = to_nanotons(data['amount'])
+    except (ArithmeticError, ValueError):  # Decimal errors and OverflowError are ArithmeticErrors
+        return jsonify({'error': 'Invalid amount'}), 400
     lock_period = int(data['lock_period'])
     
-    # Calculate fee (5% from both sender and receiver)
-    fee_amount = amount * 0.1
-    total_amount = amount + (fee_amount / 2)  # Sender pays half the fee initially
+    # Calculate fee (5% from both sender and receiver), in exact nanotons
+    fee_nanotons = amount_nanotons // 10
+    amount = amount_nanotons / NANOTONS_PER_TON
+    fee_amount = fee_nanotons / NANOTONS_PER_TON
+    total_amount = (amount_nanotons + fee_nanotons // 2) / NANOTONS_PER_TON  # Sender pays half the fee initially
     
     # Check if using point card
     use_card = data.get('use_point_card', False)
@@ -669,6 +1096,8 @@ def create_escrow():
         receiver_wallet_address=receiver.wallet_address,
         amount=amount,
         fee_amount=fee_amount,
+        amount_nanotons=amount_nanotons,
+        fee_nanotons=fee_nanotons,
         status='active',
         lock_period=lock_period,
         unlock_time=unlock_time,
@@ -689,47 +1118,49 @@ def create_escrow():
         'escrow': escrow.to_dict()
     }), 201
 
-@app.route('/api/escrow/info/<string:escrow_id>', methods=['GET'])
+@api.route('/api/escrow/info/<string:escrow_id>', methods=['GET'])
+@read_only(max_staleness=5)
 def get_escrow_info(escrow_id):
     escrow = Escrow.query.filter_by(escrow_id=escrow_id).first()
-    if not escrow:
+    if escrow:
+        return jsonify(escrow.to_dict()), 200
+    
+    # Finished escrows may have been moved to the archive
+    archived = project_escrows(EscrowArchive.escrow_id == escrow_id, model=EscrowArchive)
+    if not archived:
         return jsonify({'error': 'Escrow not found'}), 404
         
-    return jsonify(escrow.to_dict()), 200
+    escrow = archived[0]
+    return jsonify(serialize_escrow(escrow, escrow.sender_username, escrow.receiver_username)), 200
 
-@app.route('/api/escrow/release/<string:escrow_id>', methods=['POST'])
+@api.route('/api/escrow/release/<string:escrow_id>', methods=['POST'])
 def release_escrow(escrow_id):
     data = request.json
     if not data or 'telegram_id' not in data:
         return jsonify({'error': 'Missing telegram_id'}), 400
         
     user = get_user_by_telegram_id(data['telegram_id'])
-    escrow = Escrow.query.filter_by(escrow_id=escrow_id).first()
-    
     if not user:
         return jsonify({'error': 'User not found'}), 404
-        
+    
+    # Release funds to receiver, only if the user is the sender and the escrow is still active
+    if escrow_transitions.release(db.session, escrow_id, user.id):
+        db.session.commit()
+        return jsonify({
+            'status': 'success',
+            'message': 'Funds released successfully'
+        }), 200
+    db.session.rollback()
+    
+    # Nothing changed, look at the escrow to tell the user why
+    escrow = Escrow.query.filter_by(escrow_id=escrow_id).first()
     if not escrow:
         return jsonify({'error': 'Escrow not found'}), 404
-        
-    # Verify user is the sender
     if escrow.sender_id != user.id:
         return jsonify({'error': 'Only the sender can release funds early'}), 403
-        
-    # Verify escrow is active
-    if escrow.status != 'active':
-        return jsonify({'error': 'Escrow is not active'}), 400
-        
-    # Release funds to receiver
-    escrow.status = 'completed'
-    db.session.commit()
-    
-    return jsonify({
-        'status': 'success',
-        'message': 'Funds released successfully'
-    }), 200
+    return jsonify({'error': 'Escrow is not active'}), 400
 
-@app.route('/api/escrow/withdraw/<string:escrow_id>', methods=['POST'])
+@api.route('/api/escrow/withdraw/<string:escrow_id>', methods=['POST'])
 def withdraw_escrow(escrow_id):
     data = request.json
     if not data or 'telegram_id' not in data or 'pin' not in data:
@@ -749,20 +1180,25 @@ def withdraw_escrow(escrow_id):
         return jsonify({'error': 'Only the receiver can withdraw funds'}), 403
         
     # Verify escrow is active
-    if escrow.status != 'active':
+    if escrow.status != escrow_states.ACTIVE:
         return jsonify({'error': 'Escrow is not active'}), 400
         
     # Verify unlock time has passed
-    if datetime.utcnow() < escrow.unlock_time:
+    now = datetime.utcnow()
+    if now < escrow.unlock_time:
         return jsonify({'error': 'Escrow is still locked'}), 400
         
     # Verify PIN
     if not check_password_hash(escrow.pin_hash, data['pin']):
         return jsonify({'error': 'Invalid PIN'}), 401
         
-    # Process withdrawal
+    # Process withdrawal. The checks above ran on a snapshot, the update only
+    # applies if the escrow is still active, so a concurrent release or
+    # cancellation can't be overwritten.
     # In a real app, this would transfer TON to the receiver
-    escrow.status = 'completed'
+    if not escrow_transitions.withdraw(db.session, escrow_id, user.id, now):
+        db.session.rollback()
+        return jsonify({'error': 'Escrow is not active'}), 400
     db.session.commit()
     
     return jsonify({
@@ -770,71 +1206,50 @@ def withdraw_escrow(escrow_id):
         'message': 'Funds withdrawn successfully'
     }), 200
 
-@app.route('/api/escrow/cancel/<string:escrow_id>', methods=['POST'])
+@api.route('/api/escrow/cancel/<string:escrow_id>', methods=['POST'])
 def cancel_escrow(escrow_id):
     data = request.json
     if not data or 'telegram_id' not in data:
         return jsonify({'error': 'Missing telegram_id'}), 400
         
     user = get_user_by_telegram_id(data['telegram_id'])
-    escrow = Escrow.query.filter_by(escrow_id=escrow_id).first()
-    
     if not user:
         return jsonify({'error': 'User not found'}), 404
-        
-    if not escrow:
-        return jsonify({'error': 'Escrow not found'}), 404
-        
-    # Verify user is either sender or receiver
-    if escrow.sender_id != user.id and escrow.receiver_id != user.id:
-        return jsonify({'error': 'Only the sender or receiver can request cancellation'}), 403
-        
-    # Verify escrow is active
-    if escrow.status != 'active' and escrow.status != 'pending_cancel':
-        return jsonify({'error': 'Escrow is not active or pending cancellation'}), 400
     
-    # Implement proper cancellation workflow
-    # Check if user is sender or receiver
-    is_sender = (escrow.sender_id == user.id)
-    
-    # Process cancellation request
-    if escrow.status == 'pending_cancel':
-        # Check if the other party is confirming the cancellation
-        if (is_sender and escrow.cancel_status == 'receiver_requested') or \
-           (not is_sender and escrow.cancel_status == 'sender_requested'):
-            # Both parties have confirmed cancellation
-            escrow.status = 'cancelled'
-            escrow.cancel_status = 'mutual'
-            db.session.commit()
-            
-            return jsonify({
-                'status': 'success',
-                'message': 'Escrow cancelled successfully'
-            }), 200
-        else:
-            # This is the same person trying to cancel again
-            return jsonify({
-                'status': 'pending',
-                'message': 'Cancellation already requested. Waiting for the other party.'
-            }), 200
-    else:
-        # First cancellation request
-        escrow.status = 'pending_cancel'
-        escrow.requested_by = user.id
-        
-        if is_sender:
-            escrow.cancel_status = 'sender_requested'
-        else:
-            escrow.cancel_status = 'receiver_requested'
-            
+    # Cancellation needs both parties: the first request moves an active
+    # escrow to pending_cancel, the other party's request cancels it
+    if escrow_transitions.request_cancel(db.session, escrow_id, user.id):
         db.session.commit()
-        
         return jsonify({
             'status': 'pending',
             'message': 'Cancellation request submitted. Waiting for confirmation from the other party.'
         }), 200
+    
+    if escrow_transitions.confirm_cancel(db.session, escrow_id, user.id):
+        db.session.commit()
+        return jsonify({
+            'status': 'success',
+            'message': 'Escrow cancelled successfully'
+        }), 200
+    db.session.rollback()
+    
+    # Nothing changed, look at the escrow to tell the user why
+    escrow = Escrow.query.filter_by(escrow_id=escrow_id).first()
+    if not escrow:
+        return jsonify({'error': 'Escrow not found'}), 404
+    if escrow.sender_id != user.id and escrow.receiver_id != user.id:
+        return jsonify({'error': 'Only the sender or receiver can request cancellation'}), 403
+    if escrow.status != escrow_states.PENDING_CANCEL:
+        return jsonify({'error': 'Escrow is not active or pending cancellation'}), 400
+    
+    # This is the same person trying to cancel again
+    return jsonify({
+        'status': 'pending',
+        'message': 'Cancellation already requested. Waiting for the other party.'
+    }), 200
 
-@app.route('/api/escrow/list', methods=['GET'])
+@api.route('/api/escrow/list', methods=['GET'])
+@read_only(max_staleness=5)
 def list_escrows():
     telegram_id = request.args.get('telegram_id')
     if not telegram_id:
@@ -844,24 +1259,366 @@ def list_escrows():
     if not user:
         return jsonify({'error': 'User not found'}), 404
         
-    # Get escrows where user is either sender or receiver
-    sent_escrows = Escrow.query.filter_by(sender_id=user.id).all()
-    received_escrows = Escrow.query.filter_by(receiver_id=user.id).all()
+    # Get escrows where user is either sender or receiver, sent ones first
+    escrows = project_escrows(
+        or_(Escrow.sender_id == user.id, Escrow.receiver_id == user.id),
+        order_by=(case((Escrow.sender_id == user.id, 0), else_=1), Escrow.id)
+    )
     
     # Separate active and past escrows
     active_escrows = []
     past_escrows = []
+    now = datetime.utcnow()
     
-    for escrow in sent_escrows + received_escrows:
+    for escrow in escrows:
+        escrow_dict = serialize_escrow(escrow, escrow.sender_username, escrow.receiver_username, now)
         if escrow.status == 'active':
-            active_escrows.append(escrow.to_dict())
+            active_escrows.append(escrow_dict)
         else:
-            past_escrows.append(escrow.to_dict())
+            past_escrows.append(escrow_dict)
     
     return jsonify({
         'active_escrows': active_escrows,
         'past_escrows': past_escrows
     }), 200
 
+@api.route('/api/escrow/history', methods=['GET'])
+@read_only(max_staleness=30)
+def escrow_history():
+    telegram_id = request.args.get('telegram_id')
+    if not telegram_id:
+        return jsonify({'error': 'Missing telegram_id'}), 400
+        
+    user = get_user_by_telegram_id(telegram_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    before = request.args.get('before', type=int)
+    
+    # Archived escrows keep their original id, so both tables page on the same key
+    pages = []
+    for model in (Escrow, EscrowArchive):
+        criteria = [or_(model.sender_id == user.id, model.receiver_id == user.id)]
+        if model is Escrow:
+            criteria.append(Escrow.status != 'active')
+        if before:
+            criteria.append(model.id < before)
+        pages.extend(project_escrows(*criteria, order_by=(model.id.desc(),), limit=limit, model=model))
+    
+    pages.sort(key=lambda escrow: escrow.id, reverse=True)
+    pages = pages[:limit]
+    now = datetime.utcnow()
+    
+    return jsonify({
+        'escrows': [
+            serialize_escrow(escrow, escrow.sender_username, escrow.receiver_username, now)
+            for escrow in pages
+        ],
+        'next_before': pages[-1].id if len(pages) == limit else None
+    }), 200
+
+# Admin Endpoints
+def check_admin_token():
+    token = current_app.config['ADMIN_TOKEN']
+    if not token:
+        return jsonify({'error': 'Not found'}), 404
+    if not secrets.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        return jsonify({'error': 'Invalid admin token'}), 403
+    return None
+
+def escrow_window_stats(start, end, bucket):
+    # Imported here so NumPy is only loaded by processes that serve analytics
+    import analytics
+    
+    cache = current_app.extensions.get('analytics_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault(
+            'analytics_cache', analytics.WindowCache(ttl=current_app.config['ANALYTICS_CACHE_TTL'])
+        )
+    
+    def compute():
+        # Long scans run on the read-only connections and never hold up the writer
+        router = readwrite.get_read_router()
+        engines = [router.reader_for(engine) if router else engine for engine in database_engines().values()]
+        with ExitStack() as stack:
+            connections = [stack.enter_context(engine.connect()) for engine in engines]
+            return analytics.escrow_stats(
+                connections, (Escrow.__table__, EscrowArchive.__table__), start, end, bucket
+            )
+    
+    return cache.get_or_compute((start, end, bucket), compute)
+
+@api.route('/api/admin/analytics/escrows', methods=['GET'])
+def escrow_analytics():
+    import analytics
+    
+    error = check_admin_token()
+    if error:
+        return error
+    
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in analytics.BUCKET_SECONDS:
+        return jsonify({'error': 'Invalid bucket'}), 400
+    try:
+        end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else datetime.utcnow()
+        start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else end - timedelta(days=30)
+    except ValueError:
+        return jsonify({'error': 'Invalid start or end'}), 400
+    
+    # Round the window to whole buckets so repeated dashboard calls share cache entries
+    start, end = analytics.bucket_window(start, end, bucket)
+    
+    stats = escrow_window_stats(start, end, bucket)
+    return jsonify({'start': start, 'end': end, 'bucket': bucket, **stats}), 200
+
+# CLI Commands
+@api.cli.command('init-db')
+def init_db_command():
+    """Create tables and add new columns. Run once per deploy, before starting workers."""
+    create_schema()
+    click.echo("Database schema is up to date")
+
+@api.cli.command('archive-escrows')
+@click.option('--older-than-days', type=int, default=None,
+              help='Archive finished escrows created more than this many days ago.')
+@click.option('--batch-size', type=int, default=500, help='Escrows moved per transaction.')
+def archive_escrows_command(older_than_days, batch_size):
+    """Move finished escrows out of the hot escrow table."""
+    archived = archive_escrows(older_than_days, batch_size)
+    click.echo(f"Archived {archived} escrows")
+
+shards_cli = AppGroup('shards', help='Manage sharded user databases.')
+
+@shards_cli.command('split')
+@click.argument('shard_uris', nargs=-1, required=True)
+@click.option('--map', 'map_path', required=True, help='Where to write the shard map.')
+def split_shards_command(shard_uris, map_path):
+    """Split the unsharded database into SHARD_URIS. Run with the service stopped."""
+    shard_map = sharding.split_database(current_app.config['SQLALCHEMY_DATABASE_URI'], db.metadata, shard_uris, map_path)
+    click.echo(f"Wrote {map_path} with {len(shard_map.shards)} shards")
+
+@shards_cli.command('add')
+@click.argument('shard_id')
+@click.argument('uri')
+def add_shard_command(shard_id, uri):
+    """Register an empty shard, move slots onto it with move-slots."""
+    shard_map = sharding.ShardMap.load(current_app.config['SHARD_MAP'])
+    shard_map.shards[shard_id] = uri
+    shard_map.version += 1
+    shard_map.save(current_app.config['SHARD_MAP'])
+    click.echo(f"Added shard {shard_id}")
+
+@shards_cli.command('move-slots')
+@click.option('--to', 'target_shard', required=True, help='Shard that receives the slots.')
+@click.option('--from', 'source_shard', default=None, help='Move every slot of this shard.')
+@click.option('--count', type=int, default=None, help='Only move this many slots.')
+def move_slots_command(target_shard, source_shard, count):
+    """Move slots between shards while the service keeps running."""
+    shard_map = sharding.ShardMap.load(current_app.config['SHARD_MAP'])
+    slots = shard_map.slots_on(source_shard) if source_shard else [
+        slot for slot, owner in enumerate(shard_map.slots) if owner != target_shard
+    ]
+    moved = sharding.move_slots(current_app.config['SHARD_MAP'], db.metadata, slots[:count], target_shard)
+    click.echo(f"Moved {moved} slots to shard {target_shard}")
+
+@shards_cli.command('relay')
+def relay_outbox_command():
+    """Deliver pending outbox messages."""
+    delivered = 0
+    while True:
+        batch = deliver_outbox()
+        delivered += batch
+        if not batch:
+            break
+    click.echo(f"Delivered {delivered} messages")
+
+@shards_cli.command('purge-outbox')
+@click.option('--older-than-days', type=int, default=None,
+              help='Keep messages delivered more recently. Defaults to OUTBOX_RETENTION_DAYS.')
+def purge_outbox_command(older_than_days):
+    """Delete delivered outbox messages and old inbox entries."""
+    purged = purge_outbox(older_than_days)
+    click.echo(f"Purged {purged} delivered messages")
+
+api.cli.add_command(shards_cli)
+
+data_cli = AppGroup('data', help='Export and import data as compressed NDJSON.')
+EXPORT_TABLES = ('user', 'point_card', 'upgrade', 'escrow', 'escrow_archive')
+
+@data_cli.command('export')
+@click.argument('directory')
+@click.option('--table', 'tables', multiple=True, help='Table to export, repeatable. Defaults to users, cards, upgrades, escrows and archived escrows.')
+@click.option('--batch-size', type=int, default=10000, help='Rows fetched per round-trip.')
+def export_data_command(directory, tables, batch_size):
+    """Stream tables into DIRECTORY/<table>.ndjson.gz."""
+    os.makedirs(directory, exist_ok=True)
+    with ExitStack() as stack:
+        connections = [stack.enter_context(engine.connect()) for engine in database_engines().values()]
+        for name in tables or EXPORT_TABLES:
+            table = db.metadata.tables[name]
+            count = dataio.export_table(connections, table, dataio.table_path(directory, table), batch_size)
+            click.echo(f"Exported {count} rows from {name}")
+
+@data_cli.command('import')
+@click.argument('directory')
+@click.option('--table', 'tables', multiple=True, help='Table to import, repeatable. Defaults to users, cards, upgrades, escrows and archived escrows.')
+@click.option('--batch-size', type=int, default=10000, help='Rows per executemany.')
+@click.option('--commit-every', type=int, default=200000, help='Rows per transaction.')
+@click.option('--replace', is_flag=True, help='Overwrite rows that already exist.')
+def import_data_command(directory, tables, batch_size, commit_every, replace):
+    """Bulk load DIRECTORY/<table>.ndjson.gz files written by export. Run with the service stopped."""
+    with ExitStack() as stack:
+        connections = {
+            key: stack.enter_context(engine.connect()) for key, engine in database_engines().items()
+        }
+        for name in tables or EXPORT_TABLES:
+            table = db.metadata.tables[name]
+            path = dataio.table_path(directory, table)
+            if not os.path.exists(path):
+                click.echo(f"Skipping {name}, {path} not found")
+                continue
+            route = None
+            shard_router = get_shard_router()
+            if shard_router:
+                route = lambda row, name=name: shard_router.shard_for_slot(sharding.slot_for_row(name, row))
+            count = dataio.import_table(connections, table, path, route, batch_size, commit_every, replace)
+            click.echo(f"Imported {count} rows into {name}")
+        for conn in connections.values():
+            # Imported archived escrows may be newer than every escrow left in the hot table
+            reserve_archived_ids(conn)
+            conn.commit()
+
+api.cli.add_command(data_cli)
+
+escrows_cli = AppGroup('escrows', help='Move escrows between states in bulk.')
+
+def read_escrow_ids(escrow_ids, path):
+    if path:
+        with open(path) as src:
+            escrow_ids += tuple(line.strip() for line in src if line.strip())
+    return escrow_ids
+
+@escrows_cli.command('release')
+@click.argument('escrow_ids', nargs=-1)
+@click.option('--file', 'path', default=None, help='Read more escrow ids from this file, one per line.')
+def release_escrows_command(escrow_ids, path):
+    """Complete ESCROW_IDS that are still active."""
+    released = escrow_transitions.release_many(db.session, read_escrow_ids(escrow_ids, path))
+    db.session.commit()
+    click.echo(f"Released {released} escrows")
+
+@escrows_cli.command('cancel')
+@click.argument('escrow_ids', nargs=-1)
+@click.option('--file', 'path', default=None, help='Read more escrow ids from this file, one per line.')
+def cancel_escrows_command(escrow_ids, path):
+    """Cancel ESCROW_IDS that are active or pending cancellation."""
+    cancelled = escrow_transitions.cancel_many(db.session, read_escrow_ids(escrow_ids, path))
+    db.session.commit()
+    click.echo(f"Cancelled {cancelled} escrows")
+
+api.cli.add_command(escrows_cli)
+
+# Application factory
+def create_app(config=None):
+    """
+    Build the app. This only reads configuration and registers routes, no
+    database is opened until the first query, and tables are created by
+    `flask init-db` rather than on every start.
+    """
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    load_config(app)
+    if config:
+        app.config.update(config)
+    
+    logging.basicConfig(level=app.config['LOG_LEVEL'])
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+    
+    cors.init_app(app)
+    idempotency.init_app(app)
+    db.init_app(app)
+    shard_router = sharding.ShardRouter.from_config(app)
+    if shard_router:
+        shard_router.init_db(db)
+    app.extensions['shard_router'] = shard_router
+    app.extensions['read_router'] = readwrite.ReadRouter.from_config(app)
+    app.register_blueprint(api)
+    return app
+
+def default_analytics_window(bucket='day'):
+    """The window the analytics endpoint uses when no start or end is given"""
+    import analytics
+    
+    end = datetime.utcnow()
+    return analytics.bucket_window(end - timedelta(days=30), end, bucket)
+
+# Read-only requests that touch the hot code paths, used to warm up a
+# process. `{telegram_id}` is filled in by `warm_up_telegram_id()`.
+WARM_UP_PATHS = (
+    '/api/auth/get_user?telegram_id={telegram_id}',
+    '/api/game/stats?telegram_id={telegram_id}',
+    '/api/shop/inventory?telegram_id={telegram_id}',
+    '/api/escrow/list?telegram_id={telegram_id}',
+    '/api/escrow/history?telegram_id={telegram_id}',
+)
+
+def warm_up_telegram_id():
+    """A real user for the warm-up requests, the sender of the newest escrow if there is one"""
+    row = db.session.query(User.telegram_id).join(Escrow, Escrow.sender_id == User.id) \
+        .order_by(Escrow.id.desc()).first() or db.session.query(User.telegram_id).first()
+    return row.telegram_id if row else None
+
+def warm_up(app):
+    """
+    Fill in-process caches before workers are forked so they inherit them
+    copy-on-write: SQLAlchemy's mapper setup and compiled statements, lazily
+    imported modules and, when the admin API is enabled, the default
+    analytics window.
+
+    The warm-up requests run as an existing user, picked to have escrows
+    so the serializers run too. The escrow projections are also compiled
+    directly, so they are warm even on an empty database.
+
+    Every connection opened here is closed again, since a SQLite handle must
+    not be shared across a fork.
+    """
+    with app.app_context():
+        engines = database_engines().values()
+        if not all(schema_is_current(engine) for engine in engines):
+            app.logger.warning("Skipping warm-up, the database schema is missing or out of date. Run `flask init-db`.")
+        else:
+            for model in (Escrow, EscrowArchive):
+                project_escrows(model.sender_id == 0, order_by=(model.id.desc(),), limit=1, model=model)
+            telegram_id = warm_up_telegram_id()
+            db.session.rollback()
+            if telegram_id is not None:
+                client = app.test_client()
+                for path in WARM_UP_PATHS:
+                    client.get(path.format(telegram_id=quote(str(telegram_id))))
+            if app.config['ADMIN_TOKEN']:
+                escrow_window_stats(*default_analytics_window(), 'day')
+        db.session.remove()
+        for engine in engines:
+            engine.dispose()
+        if app.extensions['read_router']:
+            app.extensions['read_router'].dispose()
+        app.extensions['idempotency'].dispose()
+
+def __getattr__(name):
+    # `gunicorn app:app` and other deployments from before create_app() get
+    # an app built on first access, with the schema created or upgraded the
+    # way every start used to do it. New deployments use wsgi:app.
+    if name == 'app':
+        global app
+        app = create_app()
+        with app.app_context():
+            create_schema()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_schema()
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""
+Time the escrow analytics engine on a large synthetic escrow table, cold and
+from the window cache.
+
+Run from the backend directory:
+
+    python benchmarks/bench_analytics.py --escrows 10000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Point the app at a scratch database before it is imported
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'bench.db')
+os.environ['ADMIN_TOKEN'] = 'bench'
+
+import logging  # noqa: E402
+
+from app import Escrow, create_app, create_schema, db  # noqa: E402
+
+app = create_app()
+with app.app_context():
+    create_schema()
+
+STATUSES = ('active', 'completed', 'completed', 'completed', 'cancelled', 'pending_cancel')
+
+
+def seed(count, days):
+    rng = random.Random(0)
+    now = datetime.utcnow()
+    table = Escrow.__table__
+    batch = []
+    with db.engine.begin() as conn:
+        for i in range(count):
+            amount = rng.randrange(10 ** 8, 10 ** 12)
+            created = now - timedelta(seconds=rng.randrange(days * 86400))
+            batch.append({
+                'escrow_id': f'escrow-{i}',
+                'sender_id': 1,
+                'sender_wallet_address': 'EQ',
+                'receiver_id': 2,
+                'receiver_wallet_address': 'EQ',
+                'amount': amount / 10 ** 9,
+                'fee_amount': amount // 10 / 10 ** 9,
+                'amount_nanotons': amount,
+                'fee_nanotons': amount // 10,
+                'status': rng.choice(STATUSES),
+                'creation_time': created,
+                'lock_period': rng.choice((1, 3, 7, 14, 30, 90)),
+                'unlock_time': created,
+                'pin_hash': 'x',
+                'card_used': rng.random() < 0.2
+            })
+            if len(batch) == 50000:
+                conn.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(table.insert(), batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--escrows', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=365)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with app.app_context():
+        start = time.perf_counter()
+        seed(args.escrows, args.days)
+        print(f"Seeded {args.escrows} escrows in {time.perf_counter() - start:.1f}s")
+
+    client = app.test_client()
+    url = f'/api/admin/analytics/escrows?bucket=day&start={(datetime.utcnow() - timedelta(days=args.days + 1)).isoformat()}'
+    for label in ('cold', 'cached'):
+        start = time.perf_counter()
+        response = client.get(url, headers={'X-Admin-Token': 'bench'})
+        elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.get_data(as_text=True)
+        totals = response.json['totals']
+        print(f"{label:<8} {elapsed:8.3f}s  {totals['count']} escrows, "
+              f"{totals['fee_revenue_nanotons'] / 10 ** 9:.9f} TON fee revenue")
+
+
+if __name__ == '__main__':
+    main()
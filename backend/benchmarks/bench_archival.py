@@ -0,0 +1,107 @@
+"""
+Show hot-path escrow latency with and without archival as the total number
+of escrows grows. For each size the database is rebuilt, mostly finished old
+escrows plus a fixed set of active ones are seeded, and `escrow/info` and
+`escrow/list` are timed before and after `archive_escrows()`.
+
+Run from the backend directory:
+
+    python benchmarks/bench_archival.py --sizes 10000 50000 200000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Point the app at a scratch database before it is imported
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'bench.db')
+
+import logging  # noqa: E402
+
+from app import Escrow, User, archive_escrows, create_app, db  # noqa: E402
+
+app = create_app()
+
+USERS = 1000
+ACTIVE_ESCROWS = 2000
+
+
+def seed(total):
+    db.drop_all()
+    db.create_all()
+    now = datetime.utcnow()
+    rng = random.Random(total)
+    db.session.bulk_insert_mappings(User, [
+        {'telegram_id': str(i), 'username': f'user{i}', 'wallet_address': 'EQ'}
+        for i in range(1, USERS + 1)
+    ])
+    escrows = []
+    for i in range(total):
+        active = i < ACTIVE_ESCROWS
+        created = now - timedelta(days=1 if active else rng.randint(31, 365))
+        escrows.append({
+            'escrow_id': f'escrow-{i}',
+            'sender_id': rng.randint(1, USERS),
+            'sender_wallet_address': 'EQ',
+            'receiver_id': rng.randint(1, USERS),
+            'receiver_wallet_address': 'EQ',
+            'amount': 1.0,
+            'fee_amount': 0.1,
+            'status': 'active' if active else rng.choice(('completed', 'cancelled')),
+            'creation_time': created,
+            'lock_period': 7,
+            'unlock_time': created + timedelta(days=7),
+            'pin_hash': 'x',
+            'card_used': False
+        })
+        if len(escrows) == 20000:
+            db.session.bulk_insert_mappings(Escrow, escrows)
+            escrows = []
+    db.session.bulk_insert_mappings(Escrow, escrows)
+    db.session.commit()
+
+
+def median_ms(client, urls):
+    samples = []
+    for url in urls:
+        start = time.perf_counter()
+        response = client.get(url)
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return statistics.median(samples) * 1000
+
+
+def measure(client, requests):
+    rng = random.Random(0)
+    info = [f'/api/escrow/info/escrow-{rng.randrange(ACTIVE_ESCROWS)}' for _ in range(requests)]
+    lists = [f'/api/escrow/list?telegram_id={rng.randint(1, USERS)}' for _ in range(requests)]
+    return median_ms(client, info), median_ms(client, lists)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 200000])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    client = app.test_client()
+    print(f"{'escrows':>10} {'info ms':>10} {'list ms':>10} {'archived':>10} {'info ms':>10} {'list ms':>10}")
+    with app.app_context():
+        for total in args.sizes:
+            seed(total)
+            before = measure(client, args.requests)
+            archived = archive_escrows(batch_size=5000)
+            after = measure(client, args.requests)
+            print(f"{total:>10} {before[0]:>10.2f} {before[1]:>10.2f} {archived:>10} {after[0]:>10.2f} {after[1]:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
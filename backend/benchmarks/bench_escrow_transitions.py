@@ -0,0 +1,177 @@
+"""
+Race escrow transitions against each other. Several worker processes walk
+the same active escrows in different orders; half of them try to release
+each escrow and the other half try to request its cancellation, so every
+escrow is contended. Exactly one transition per escrow may win.
+
+`legacy` is the previous pattern: load the escrow, check its status in
+Python, set the new status and commit. `cas` runs the escrow_states
+compare-and-set UPDATE. For each, the wins are counted and checked against
+the number of escrows, then the bulk transitions are timed.
+
+Run from the backend directory:
+
+    python benchmarks/bench_escrow_transitions.py --escrows 2000 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+SENDER_ID = 1
+RECEIVER_ID = 2
+
+
+def _load_app(database_url):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.pop('SHARD_MAP', None)
+    import logging
+    logging.disable(logging.WARNING)
+    import app
+    return app, app.create_app()
+
+
+def seed(backend, count, prefix):
+    now = datetime.utcnow()
+    with backend.db.engine.begin() as conn:
+        conn.execute(backend.Escrow.__table__.insert(), [{
+            'escrow_id': f'{prefix}-{i}',
+            'sender_id': SENDER_ID,
+            'sender_wallet_address': 'EQ',
+            'receiver_id': RECEIVER_ID,
+            'receiver_wallet_address': 'EQ',
+            'amount': 1.0,
+            'fee_amount': 0.1,
+            'amount_nanotons': 10 ** 9,
+            'fee_nanotons': 10 ** 8,
+            'status': 'active',
+            'creation_time': now,
+            'lock_period': 1,
+            'unlock_time': now + timedelta(days=1),
+            'pin_hash': 'x',
+            'card_used': False
+        } for i in range(count)])
+
+
+def prepare(database_url, count):
+    backend, application = _load_app(database_url)
+    with application.app_context():
+        backend.create_schema()
+        seed(backend, count, 'race')
+
+
+def legacy_transition(backend, escrow_id, release):
+    escrow = backend.Escrow.query.filter_by(escrow_id=escrow_id).first()
+    if escrow.status != 'active':
+        return 0
+    if release:
+        escrow.status = 'completed'
+    else:
+        escrow.status = 'pending_cancel'
+        escrow.requested_by = SENDER_ID
+        escrow.cancel_status = 'sender_requested'
+    return 1
+
+
+def cas_transition(backend, escrow_id, release):
+    if release:
+        return backend.escrow_transitions.release(backend.db.session, escrow_id, SENDER_ID)
+    return backend.escrow_transitions.request_cancel(backend.db.session, escrow_id, SENDER_ID)
+
+
+def worker(database_url, mode, count, index, barrier, results):
+    backend, application = _load_app(database_url)
+    from sqlalchemy.exc import OperationalError
+    transition = legacy_transition if mode == 'legacy' else cas_transition
+    release = index % 2 == 0
+    escrow_ids = [f'race-{i}' for i in range(count)]
+    random.Random(index).shuffle(escrow_ids)
+    wins = retries = 0
+    with application.app_context():
+        barrier.wait()
+        started = time.perf_counter()
+        for escrow_id in escrow_ids:
+            while True:
+                try:
+                    won = transition(backend, escrow_id, release)
+                    backend.db.session.commit()
+                    wins += won
+                    break
+                except OperationalError:
+                    # SQLite "database is locked", try the same transition again
+                    backend.db.session.rollback()
+                    retries += 1
+        results.put((wins, retries, started, time.perf_counter()))
+
+
+def race(mode, count, workers):
+    database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    ctx = multiprocessing.get_context('spawn')
+    process = ctx.Process(target=prepare, args=(database_url, count))
+    process.start()
+    process.join()
+
+    results = ctx.Queue()
+    barrier = ctx.Barrier(workers)
+    processes = [
+        ctx.Process(target=worker, args=(database_url, mode, count, index, barrier, results))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    backend, application = _load_app(database_url)
+    with application.app_context():
+        changed = backend.Escrow.query.filter(backend.Escrow.status != 'active').count()
+    wins = sum(outcome[0] for outcome in outcomes)
+    elapsed = max(outcome[3] for outcome in outcomes) - min(outcome[2] for outcome in outcomes)
+    return wins, changed, sum(outcome[1] for outcome in outcomes), workers * count / elapsed
+
+
+def bulk(count):
+    backend, application = _load_app('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    timings = {}
+    with application.app_context():
+        backend.create_schema()
+        seed(backend, count, 'bulk')
+        escrow_ids = [f'bulk-{i}' for i in range(count)]
+        for label, transition in (('release_many', backend.escrow_transitions.release_many),
+                                  ('cancel_many', backend.escrow_transitions.cancel_many)):
+            with backend.db.engine.begin() as conn:
+                conn.exec_driver_sql("UPDATE escrow SET status = 'active', cancel_status = NULL")
+            start = time.perf_counter()
+            moved = transition(backend.db.session, escrow_ids)
+            backend.db.session.commit()
+            timings[label] = (moved, time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--escrows', type=int, default=2000, help='Contended escrows per race.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--bulk', type=int, default=100000, help='Escrows moved by each bulk transition.')
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'escrows':>8} {'wins':>8} {'changed':>8} {'lost updates':>13} {'retries':>8} {'attempts/s':>11}")
+    for mode in ('legacy', 'cas'):
+        wins, changed, retries, rate = race(mode, args.escrows, args.workers)
+        # Every win past one per escrow overwrote another worker's transition
+        print(f"{mode:>8} {args.escrows:>8} {wins:>8} {changed:>8} {wins - changed:>13} {retries:>8} {rate:>11.0f}")
+
+    for label, (moved, elapsed) in bulk(args.bulk).items():
+        print(f"{label}: {moved} escrows in {elapsed:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
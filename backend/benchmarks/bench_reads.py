@@ -0,0 +1,140 @@
+"""
+Measure GET throughput while claims are written concurrently. Reader
+processes request /api/game/stats and /api/escrow/list for random users
+through the test client while one writer process keeps claiming mined
+points, for a fixed duration per configuration.
+
+`shared` is the previous setup: a rollback journal and reads on the same
+connections as writes. `routed` uses WAL and the read-only connection pool.
+
+Run from the backend directory:
+
+    python benchmarks/bench_reads.py --readers 1 2 4 --duration 5
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+USERS = 2000
+
+MODES = {
+    'shared': {'READ_POOL_SIZE': '0', 'journal': 'DELETE'},
+    'routed': {'READ_POOL_SIZE': '4', 'journal': 'WAL'},
+}
+
+
+def _load_app(database_url, mode):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.update({key: value for key, value in MODES[mode].items() if key.isupper()})
+    import logging
+    logging.disable(logging.WARNING)
+    import app
+    return app, app.create_app()
+
+
+def seed(database_url, mode):
+    backend, application = _load_app(database_url, mode)
+    with application.app_context():
+        backend.create_schema()
+        # Its pooled connection would keep the journal mode from changing
+        application.extensions['idempotency'].dispose()
+        for engine in backend.database_engines().values():
+            with engine.connect() as conn:
+                conn.exec_driver_sql(f"PRAGMA journal_mode={MODES[mode]['journal']}")
+        backend.db.session.bulk_insert_mappings(backend.User, [
+            {'telegram_id': str(i), 'username': f'user{i}', 'node_status': 'off'} for i in range(USERS)
+        ])
+        backend.db.session.commit()
+
+
+def reader(database_url, mode, seed_value, duration, barrier, results):
+    backend, application = _load_app(database_url, mode)
+    client = application.test_client()
+    rng = random.Random(seed_value)
+    reads = errors = 0
+    barrier.wait()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        telegram_id = rng.randrange(USERS)
+        path = '/api/game/stats' if reads % 2 else '/api/escrow/list'
+        if client.get(f'{path}?telegram_id={telegram_id}').status_code != 200:
+            errors += 1
+        reads += 1
+    results.put(('read', reads, errors))
+
+
+def writer(database_url, mode, duration, barrier, results):
+    backend, application = _load_app(database_url, mode)
+    from sqlalchemy import update
+    client = application.test_client()
+    rng = random.Random(0)
+    claims = errors = 0
+    barrier.wait()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        telegram_id = str(rng.randrange(USERS))
+        # Finish the user's mining session, then claim it like the app would
+        with application.app_context():
+            backend.db.session.execute(update(backend.User).where(backend.User.telegram_id == telegram_id).values(
+                node_status='on', node_expiry_time=datetime.utcnow() - timedelta(seconds=1)
+            ))
+            backend.db.session.commit()
+        if client.post('/api/game/claim', json={'telegram_id': telegram_id}).status_code != 200:
+            errors += 1
+        claims += 1
+    results.put(('write', claims, errors))
+
+
+def run(mode, readers, duration):
+    database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    ctx = multiprocessing.get_context('spawn')
+    process = ctx.Process(target=seed, args=(database_url, mode))
+    process.start()
+    process.join()
+
+    results = ctx.Queue()
+    barrier = ctx.Barrier(readers + 1)  # Start every process together once they have imported the app
+    processes = [
+        ctx.Process(target=reader, args=(database_url, mode, index, duration, barrier, results))
+        for index in range(readers)
+    ]
+    processes.append(ctx.Process(target=writer, args=(database_url, mode, duration, barrier, results)))
+    for process in processes:
+        process.start()
+    totals = {'read': [0, 0], 'write': [0, 0]}
+    for _ in processes:
+        kind, count, errors = results.get()
+        totals[kind][0] += count
+        totals[kind][1] += errors
+    for process in processes:
+        process.join()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--readers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per configuration.')
+    args = parser.parse_args()
+
+    print(f"cores: {os.cpu_count()}")
+    print(f"{'mode':>8} {'readers':>8} {'reads/s':>10} {'read errors':>12} {'claims/s':>10} {'claim errors':>13}")
+    for mode in MODES:
+        for readers in args.readers:
+            totals = run(mode, readers, args.duration)
+            reads, read_errors = totals['read']
+            claims, claim_errors = totals['write']
+            print(f"{mode:>8} {readers:>8} {reads / args.duration:>10.0f} {read_errors:>12} "
+                  f"{claims / args.duration:>10.0f} {claim_errors:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Compare the legacy JSON response path (full ORM objects, per-field
+`.isoformat()`, a User lookup per escrow side, Flask's default encoder) with
+the column projections and FastJSONProvider used by the endpoints now.
+
+Run from the backend directory:
+
+    python benchmarks/bench_serialization.py --escrows 20000 --referrals 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Point the app at a scratch database before it is imported
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'bench.db')
+
+import logging  # noqa: E402
+import warnings  # noqa: E402
+
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+import app as backend  # noqa: E402
+from app import Escrow, User, create_app, create_schema, db  # noqa: E402
+
+app = create_app()
+with app.app_context():
+    create_schema()
+
+
+def seed(escrow_count, referral_count):
+    now = datetime.utcnow()
+    alice = User(telegram_id='1', username='alice', referral_code='ALICE1')
+    bob = User(telegram_id='2', username='bob', referral_code='BOB222')
+    db.session.add_all([alice, bob])
+    db.session.flush()
+    db.session.bulk_insert_mappings(User, [
+        {
+            'telegram_id': str(1000 + i),
+            'username': f'user{i}',
+            'points_mined': i,
+            'last_mine_time': now,
+            'referrer_id': alice.id
+        } for i in range(referral_count)
+    ])
+    db.session.bulk_insert_mappings(Escrow, [
+        {
+            'escrow_id': f'escrow-{i}',
+            'sender_id': alice.id if i % 2 else bob.id,
+            'sender_wallet_address': 'EQ-sender',
+            'receiver_id': bob.id if i % 2 else alice.id,
+            'receiver_wallet_address': 'EQ-receiver',
+            'amount': 1.5,
+            'fee_amount': 0.15,
+            'status': 'active' if i % 3 else 'completed',
+            'creation_time': now,
+            'lock_period': 7,
+            'unlock_time': now + timedelta(days=7),
+            'pin_hash': 'x',
+            'card_used': False
+        } for i in range(escrow_count)
+    ])
+    db.session.commit()
+    return alice
+
+
+def legacy_escrow_dict(escrow):
+    return {
+        'id': escrow.id,
+        'escrow_id': escrow.escrow_id,
+        'sender_username': User.query.get(escrow.sender_id).username,
+        'receiver_username': User.query.get(escrow.receiver_id).username,
+        'amount': escrow.amount,
+        'fee_amount': escrow.fee_amount,
+        'status': escrow.status,
+        'creation_time': escrow.creation_time.isoformat(),
+        'lock_period': escrow.lock_period,
+        'unlock_time': escrow.unlock_time.isoformat(),
+        'card_used': escrow.card_used,
+        'can_withdraw': datetime.utcnow() >= escrow.unlock_time and escrow.status == 'active',
+        'cancel_status': escrow.cancel_status,
+        'requested_by': escrow.requested_by
+    }
+
+
+def legacy_list_escrows(user, provider):
+    sent = Escrow.query.filter_by(sender_id=user.id).all()
+    received = Escrow.query.filter_by(receiver_id=user.id).all()
+    active, past = [], []
+    for escrow in sent + received:
+        (active if escrow.status == 'active' else past).append(legacy_escrow_dict(escrow))
+    return provider.response({'active_escrows': active, 'past_escrows': past})
+
+
+def legacy_get_referrals(user, provider):
+    referred = User.query.filter_by(referrer_id=user.id).all()
+    return provider.response({
+        'referral_code': user.referral_code,
+        'referral_count': len(referred),
+        'referred_users': [
+            {
+                'username': r.username,
+                'points_mined': r.points_mined,
+                'joined_date': r.last_mine_time.isoformat()
+            } for r in referred
+        ]
+    })
+
+
+def timed(label, fn, repeat):
+    best = float('inf')
+    size = 0
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        response = fn()
+        best = min(best, time.perf_counter() - start)
+        size = len(response.get_data())
+    print(f"{label:<32} {best * 1000:9.1f} ms  {size / 1024:9.1f} KiB")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--escrows', type=int, default=10000)
+    parser.add_argument('--referrals', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    warnings.simplefilter('ignore')
+    legacy_provider = DefaultJSONProvider(app)
+
+    with app.app_context():
+        alice = seed(args.escrows, args.referrals)
+        telegram_id = alice.telegram_id
+        print(f"{args.escrows} escrows, {args.referrals} referrals, best of {args.repeat}")
+
+        with app.test_request_context(f'/api/escrow/list?telegram_id={telegram_id}'):
+            old = timed('escrow/list (legacy)', lambda: legacy_list_escrows(
+                backend.get_user_by_telegram_id(telegram_id), legacy_provider), args.repeat)
+            new = timed('escrow/list (projection)', lambda: backend.list_escrows()[0], args.repeat)
+            print(f"{'':<32} {old / new:9.1f}x")
+
+        with app.test_request_context(f'/api/auth/get_referrals?telegram_id={telegram_id}'):
+            old = timed('get_referrals (legacy)', lambda: legacy_get_referrals(
+                backend.get_user_by_telegram_id(telegram_id), legacy_provider), args.repeat)
+            new = timed('get_referrals (projection)', lambda: backend.get_referrals()[0], args.repeat)
+            print(f"{'':<32} {old / new:9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Measure write throughput as the number of shards grows. For each shard count
+a fresh set of SQLite shards is created and seeded with users, then several
+worker processes each run the same number of point updates (a read and a
+committed write of one user, like a claim) on random users.
+
+Run from the backend directory:
+
+    python benchmarks/bench_sharding.py --shards 1 2 4 --workers 4 --writes 500
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+USERS = 2000
+
+
+def _load_app(map_path, tmpdir):
+    os.environ['SHARD_MAP'] = map_path
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir, 'unused.db')
+    import logging
+    logging.disable(logging.INFO)
+    import app
+    application = app.create_app()
+    with application.app_context():
+        app.create_schema()
+    return app, application
+
+
+def seed(map_path, tmpdir):
+    backend, application = _load_app(map_path, tmpdir)
+    with application.app_context():
+        for i in range(USERS):
+            backend.db.session.add(backend.User(telegram_id=str(i), username=f'user{i}'))
+        backend.db.session.commit()
+
+
+def worker(map_path, tmpdir, writes, seed_value, barrier, results):
+    backend, application = _load_app(map_path, tmpdir)
+    from sqlalchemy.exc import OperationalError
+    rng = random.Random(seed_value)
+    retries = 0
+    with application.app_context():
+        barrier.wait()
+        started = time.perf_counter()
+        for _ in range(writes):
+            telegram_id = str(rng.randrange(USERS))
+            while True:
+                try:
+                    user = backend.get_user_by_telegram_id(telegram_id)
+                    user.points_mined += 1
+                    backend.db.session.commit()
+                    break
+                except OperationalError:
+                    # SQLite "database is locked", the single-writer limit at work
+                    backend.db.session.rollback()
+                    retries += 1
+    results.put((started, time.perf_counter(), retries))
+
+
+def run(shard_count, workers, writes):
+    import sharding
+
+    tmpdir = tempfile.mkdtemp()
+    map_path = os.path.join(tmpdir, 'shards.json')
+    uris = ['sqlite:///' + os.path.join(tmpdir, f'shard_{i}.db') for i in range(shard_count)]
+    sharding.ShardMap.even(uris).save(map_path)
+
+    ctx = multiprocessing.get_context('spawn')
+    process = ctx.Process(target=seed, args=(map_path, tmpdir))
+    process.start()
+    process.join()
+
+    results = ctx.Queue()
+    barrier = ctx.Barrier(workers)  # Start timing once every worker has imported the app
+    processes = [
+        ctx.Process(target=worker, args=(map_path, tmpdir, writes, index, barrier, results))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    timings = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = max(end for _, end, _ in timings) - min(start for start, _, _ in timings)
+    return workers * writes / elapsed, sum(retries for _, _, retries in timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--writes', type=int, default=500, help='Writes per worker.')
+    args = parser.parse_args()
+
+    print(f"{'shards':>8} {'writes/s':>10} {'lock retries':>14}")
+    for shard_count in args.shards:
+        throughput, retries = run(shard_count, args.workers, args.writes)
+        print(f"{shard_count:>8} {throughput:>10.0f} {retries:>14}")
+
+
+if __name__ == '__main__':
+    main()
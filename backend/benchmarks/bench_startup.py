@@ -0,0 +1,115 @@
+"""
+Measure cold start: how long a fresh process takes from launch to its first
+response. Each in-process run is a new interpreter that imports the app,
+builds it with create_app() and serves one request through the test client,
+with and without warm_up() in between. The gunicorn run starts the server
+with gunicorn.conf.py and polls until the first request succeeds.
+
+Run from the backend directory:
+
+    python benchmarks/bench_startup.py --runs 5 --workers 2
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATH = '/api/escrow/list?telegram_id=0'
+
+PROCESS = '''
+import json, sys, time
+started = time.perf_counter()
+import app as backend
+imported = time.perf_counter()
+application = backend.create_app()
+created = time.perf_counter()
+if sys.argv[1] == 'warm':
+    backend.warm_up(application)
+warmed = time.perf_counter()
+response = application.test_client().get(%r)
+answered = time.perf_counter()
+assert response.status_code in (200, 404), response.status_code
+print(json.dumps({
+    'import': imported - started,
+    'create_app': created - imported,
+    'warm_up': warmed - created,
+    'first_request': answered - warmed,
+    'total': answered - started,
+}))
+''' % PATH
+
+
+def run_process(env, mode):
+    output = subprocess.run(
+        [sys.executable, '-c', PROCESS, mode], cwd=BACKEND, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_gunicorn(env, workers):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers)],
+        cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}{PATH}', timeout=5)
+                break
+            except urllib.error.HTTPError:
+                break  # Any HTTP response means a worker is serving
+            except (urllib.error.URLError, ConnectionError):
+                if server.poll() is not None:
+                    raise RuntimeError('gunicorn exited during startup')
+                time.sleep(0.01)
+        return time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2, help='Gunicorn workers.')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(tmpdir, 'bench.db'), FLASK_APP='app:create_app()')
+    env.pop('SHARD_MAP', None)
+    subprocess.run([sys.executable, '-m', 'flask', 'init-db'], cwd=BACKEND, env=env, check=True, capture_output=True)
+
+    fields = ('import', 'create_app', 'warm_up', 'first_request', 'total')
+    print(f"{'process':>10}" + ''.join(f'{name:>15}' for name in fields) + '   (median ms)')
+    for mode in ('cold', 'warm'):
+        samples = [run_process(env, mode) for _ in range(args.runs)]
+        medians = [statistics.median(sample[name] for sample in samples) * 1000 for name in fields]
+        print(f'{mode:>10}' + ''.join(f'{value:>15.1f}' for value in medians))
+
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        print('gunicorn is not installed, skipping the server measurement')
+        return
+    boots = [run_gunicorn(env, args.workers) for _ in range(args.runs)]
+    print(f'gunicorn, {args.workers} workers: launch to first response {statistics.median(boots) * 1000:.0f} ms median')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Streaming NDJSON export and import of database tables.
+
+Each table is written to `<table>.ndjson.gz`, one JSON object per row. Rows
+are streamed with `yield_per` on export and inserted with executemany in
+large transactions on import, so memory use stays flat no matter how many
+rows are moved.
+"""
+import gzip
+import os
+from datetime import datetime
+
+from sqlalchemy import DateTime, select
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib encoder
+    orjson = None
+    import json
+
+
+def _dumps(row):
+    if orjson is not None:
+        return orjson.dumps(row) + b'\n'
+    return (json.dumps(row, default=lambda value: value.isoformat()) + '\n').encode()
+
+
+def _loads(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+
+def table_path(directory, table):
+    return os.path.join(directory, f'{table.name}.ndjson.gz')
+
+
+def export_table(connections, table, path, batch_size=10000, compresslevel=6):
+    """
+    Stream every row of `table` from each of `connections` into a gzipped
+    NDJSON file. Returns the number of rows written.
+    """
+    count = 0
+    with gzip.open(path, 'wb', compresslevel=compresslevel) as out:
+        for conn in connections:
+            result = conn.execution_options(yield_per=batch_size).execute(
+                select(table).order_by(*table.primary_key.columns)
+            )
+            for partition in result.mappings().partitions():
+                out.write(b''.join(_dumps(dict(row)) for row in partition))
+                count += len(partition)
+    return count
+
+
+def read_rows(table, path, batch_size=10000):
+    """Yield lists of at most `batch_size` rows from an export, ready to insert"""
+    datetime_columns = [column.name for column in table.columns if isinstance(column.type, DateTime)]
+    batch = []
+    with gzip.open(path, 'rb') as src:
+        for line in src:
+            row = _loads(line)
+            for name in datetime_columns:
+                if row.get(name) is not None:
+                    row[name] = datetime.fromisoformat(row[name])
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def import_table(connections, table, path, route=None, batch_size=10000, commit_every=200000, replace=False):
+    """
+    Bulk insert an export into `table`. Run it with the service stopped,
+    rows become visible in batches and the table is missing its secondary
+    indexes until the import ends.
+
+    `connections` maps a key to an open connection and `route(row)` picks the
+    key for a row; without `route` there must be a single connection. The
+    table's non-unique indexes are dropped first and rebuilt once every row
+    is in, and each connection commits after about `commit_every` rows.
+    Unique indexes stay in place, so a row that duplicates a unique key
+    fails its batch rather than being committed, and `OR REPLACE` can find
+    the rows it overwrites. Returns the number of rows imported.
+    """
+    insert = table.insert()
+    if replace:
+        insert = insert.prefix_with('OR REPLACE')
+    indexes = [index for index in table.indexes if not index.unique]
+
+    for conn in connections.values():
+        for index in indexes:
+            index.drop(conn, checkfirst=True)
+        conn.commit()
+
+    count = 0
+    pending = dict.fromkeys(connections, 0)
+    try:
+        for batch in read_rows(table, path, batch_size):
+            if route is None:
+                groups = {key: batch for key in connections}
+            else:
+                groups = {}
+                for row in batch:
+                    groups.setdefault(route(row), []).append(row)
+
+            for key, rows in groups.items():
+                connections[key].execute(insert, rows)
+                pending[key] += len(rows)
+                if pending[key] >= commit_every:
+                    connections[key].commit()
+                    pending[key] = 0
+            count += len(batch)
+
+        for conn in connections.values():
+            conn.commit()
+    finally:
+        for conn in connections.values():
+            conn.rollback()
+            for index in indexes:
+                index.create(conn, checkfirst=True)
+            conn.commit()
+    return count
@@ -0,0 +1,105 @@
+"""
+Escrow state machine.
+
+    active --release / withdraw--> completed
+    active --request_cancel--> pending_cancel --confirm_cancel--> cancelled
+
+Each transition is a single compare-and-set UPDATE. Its WHERE clause holds
+the state the escrow has to be in and who may move it, and the affected row
+count tells whether the transition happened. Of two calls racing for the same
+escrow exactly one gets 1 and the other 0, without loading the row first.
+Callers commit.
+"""
+from sqlalchemy import and_, case, or_, update
+
+ACTIVE = 'active'
+COMPLETED = 'completed'
+PENDING_CANCEL = 'pending_cancel'
+CANCELLED = 'cancelled'
+FINISHED = (COMPLETED, CANCELLED)
+
+# cancel_status values
+SENDER_REQUESTED = 'sender_requested'
+RECEIVER_REQUESTED = 'receiver_requested'
+MUTUAL = 'mutual'
+ADMIN = 'admin'
+
+# Ids per statement in the bulk transitions, well under SQLite's variable limit
+BULK_BATCH_SIZE = 10000
+
+
+class EscrowTransitions:
+    """Transitions of `model`, the Escrow model"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def _apply(self, session, criteria, values):
+        statement = update(self.model).where(*criteria).values(**values)
+        return session.execute(statement, execution_options={'synchronize_session': False}).rowcount
+
+    def release(self, session, escrow_id, sender_id):
+        """The sender hands the funds to the receiver before the unlock time"""
+        escrow = self.model
+        return self._apply(session, (
+            escrow.escrow_id == escrow_id,
+            escrow.sender_id == sender_id,
+            escrow.status == ACTIVE
+        ), {'status': COMPLETED})
+
+    def withdraw(self, session, escrow_id, receiver_id, now):
+        """The receiver takes the funds once the escrow has unlocked. The PIN is checked by the caller."""
+        escrow = self.model
+        return self._apply(session, (
+            escrow.escrow_id == escrow_id,
+            escrow.receiver_id == receiver_id,
+            escrow.status == ACTIVE,
+            escrow.unlock_time <= now
+        ), {'status': COMPLETED})
+
+    def request_cancel(self, session, escrow_id, user_id):
+        """Either party asks to cancel an active escrow"""
+        escrow = self.model
+        return self._apply(session, (
+            escrow.escrow_id == escrow_id,
+            or_(escrow.sender_id == user_id, escrow.receiver_id == user_id),
+            escrow.status == ACTIVE
+        ), {
+            'status': PENDING_CANCEL,
+            'requested_by': user_id,
+            'cancel_status': case((escrow.sender_id == user_id, SENDER_REQUESTED), else_=RECEIVER_REQUESTED)
+        })
+
+    def confirm_cancel(self, session, escrow_id, user_id):
+        """The other party agrees to a pending cancellation"""
+        escrow = self.model
+        return self._apply(session, (
+            escrow.escrow_id == escrow_id,
+            escrow.status == PENDING_CANCEL,
+            or_(
+                and_(escrow.sender_id == user_id, escrow.cancel_status == RECEIVER_REQUESTED),
+                and_(escrow.receiver_id == user_id, escrow.cancel_status == SENDER_REQUESTED)
+            )
+        ), {'status': CANCELLED, 'cancel_status': MUTUAL})
+
+    # Bulk transitions for the scheduler and admin tools
+
+    def _apply_many(self, session, escrow_ids, criteria, values):
+        escrow_ids = list(escrow_ids)
+        changed = 0
+        for start in range(0, len(escrow_ids), BULK_BATCH_SIZE):
+            batch = escrow_ids[start:start + BULK_BATCH_SIZE]
+            changed += self._apply(session, (self.model.escrow_id.in_(batch),) + criteria, values)
+        return changed
+
+    def release_many(self, session, escrow_ids):
+        """Complete every escrow in `escrow_ids` that is still active"""
+        return self._apply_many(session, escrow_ids, (self.model.status == ACTIVE,), {'status': COMPLETED})
+
+    def cancel_many(self, session, escrow_ids):
+        """Cancel every escrow in `escrow_ids` that is active or pending cancellation"""
+        return self._apply_many(
+            session, escrow_ids,
+            (self.model.status.in_((ACTIVE, PENDING_CANCEL)),),
+            {'status': CANCELLED, 'cancel_status': ADMIN}
+        )
@@ -0,0 +1,47 @@
+"""
+Gunicorn settings for the API, picked up automatically when gunicorn is
+started from this directory:
+
+    flask --app 'app:create_app()' init-db
+    gunicorn
+
+Every setting can still be overridden on the command line.
+"""
+import gc
+import multiprocessing
+import os
+
+wsgi_app = 'wsgi:app'
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Build and warm the app once in the master, workers are forked from it
+preload_app = True
+
+# Requests mostly wait on SQLite, so a few threads per worker keep the
+# process count (and the number of SQLite writers) low
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then, a replacement is a cheap fork of the warm master
+max_requests = 10000
+max_requests_jitter = 1000
+
+# Heartbeat files on tmpfs, a slow disk can otherwise stall workers
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+loglevel = os.environ.get('LOG_LEVEL', 'warning').lower()
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+
+
+def when_ready(server):
+    # Runs in the master after the app is preloaded and before the first
+    # fork. Freezing moves everything allocated so far out of the garbage
+    # collector's reach, so collections in the workers don't touch (and
+    # copy) the pages they share with the master.
+    gc.freeze()
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+from flask import current_app, g, jsonify, request
+from sqlalchemy import (
+    Column, Float, Index, Integer, LargeBinary, MetaData, String, Table, Text,
+    create_engine, delete, insert, select, update
+)
+
+metadata = MetaData()
+
+idempotency_keys = Table(
+    'idempotency_key', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('path', String(255), nullable=False),
+    Column('key', String(255), nullable=False),
+    Column('fingerprint', String(64), nullable=False),
+    # Random per claim, so a request whose claim expired can't overwrite the next one's
+    Column('token', String(32), nullable=False),
+    # Null while the first request is still in flight
+    Column('status', Integer, nullable=True),
+    Column('headers', Text, nullable=True),
+    Column('body', LargeBinary, nullable=True),
+    # Wall clock, shared by every process using the table
+    Column('expires_at', Float, nullable=False, index=True),
+    Index('ix_idempotency_key_path_key', 'path', 'key', unique=True)
+)
+
+
+class IdempotencyStore:
+    """
+    TTL store of completed responses and in-flight markers in a database
+    table, shared by every worker process that opens the same database.
+
+    A key is claimed by inserting its row in a transaction of its own, the
+    unique (path, key) index lets exactly one request win. Duplicates poll
+    the row until the winner stores its response or gives the key up.
+    In-flight rows expire after `lease` seconds, so a key claimed by a
+    worker that died is eventually freed.
+    """
+
+    # Expired rows are purged on every this many claims per process
+    purge_every = 100
+
+    def __init__(self, url, ttl=24 * 60 * 60, lease=60, poll_interval=0.05):
+        self.url = url
+        self.ttl = ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._engine = None
+        self._claims = 0
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = create_engine(self.url, connect_args={'timeout': 30})
+        return self._engine
+
+    def create_table(self):
+        metadata.create_all(self.engine)
+
+    def dispose(self):
+        if self._engine is not None:
+            self._engine.dispose()
+
+    @staticmethod
+    def _where(key):
+        path, name = key
+        return idempotency_keys.c.path == path, idempotency_keys.c.key == name
+
+    def begin(self, key, fingerprint):
+        """
+        Claim `key` for a new request.
+
+        Returns `(token, True)` when the caller owns the key and must call
+        `complete` or `abandon` with the token, otherwise `(fingerprint,
+        False)` with the fingerprint of the request holding it.
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        self._claims += 1
+        with self.engine.begin() as conn:
+            if self._claims % self.purge_every == 0:
+                conn.execute(delete(idempotency_keys).where(idempotency_keys.c.expires_at <= now))
+            else:
+                conn.execute(delete(idempotency_keys).where(*self._where(key), idempotency_keys.c.expires_at <= now))
+            claimed = conn.execute(insert(idempotency_keys).prefix_with('OR IGNORE').values(
+                path=key[0], key=key[1], fingerprint=fingerprint, token=token, expires_at=now + self.lease
+            )).rowcount
+            if claimed:
+                return token, True
+            return conn.execute(select(idempotency_keys.c.fingerprint).where(*self._where(key))).scalar_one(), False
+
+    def complete(self, key, token, response):
+        body, status, headers = response
+        with self.engine.begin() as conn:
+            conn.execute(update(idempotency_keys).where(*self._where(key), idempotency_keys.c.token == token).values(
+                status=status, headers=json.dumps(headers), body=body, expires_at=time.time() + self.ttl
+            ))
+
+    def abandon(self, key, token):
+        """Drop an in-flight marker so the next retry runs the request again"""
+        with self.engine.begin() as conn:
+            conn.execute(delete(idempotency_keys).where(*self._where(key), idempotency_keys.c.token == token))
+
+    def wait(self, key, timeout):
+        """
+        Wait up to `timeout` seconds for the response stored under `key`.
+        Returns the response, None once the key was given up, or raises
+        TimeoutError.
+        """
+        deadline = time.monotonic() + timeout
+        query = select(idempotency_keys.c.status, idempotency_keys.c.headers, idempotency_keys.c.body).where(
+            *self._where(key), idempotency_keys.c.expires_at > time.time()
+        )
+        while True:
+            with self.engine.connect() as conn:
+                row = conn.execute(query).first()
+            if row is None:
+                return None
+            if row.status is not None:
+                return row.body, row.status, json.loads(row.headers)
+            if time.monotonic() >= deadline:
+                raise TimeoutError(key)
+            time.sleep(self.poll_interval)
+
+
+class Idempotency:
+    """
+    Honor an `Idempotency-Key` header on every POST route.
+
+    The first request with a given key runs normally and its response is
+    stored. Retries with the same key get the stored response back without
+    touching the view, and concurrent duplicates block until the first one
+    finishes. Server errors are not stored so the client can retry them.
+    Keys are scoped to the request path and tied to a hash of the body; a
+    key reused with a different body is rejected with 422.
+
+    The store is a table in `IDEMPOTENCY_DATABASE_URI`, the app's database
+    by default, so a retry that lands on another worker is still answered
+    from it. `flask init-db` creates the table.
+    """
+
+    header = 'Idempotency-Key'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDEMPOTENCY_DATABASE_URI', app.config['SQLALCHEMY_DATABASE_URI'])
+        app.config.setdefault('IDEMPOTENCY_TTL', 24 * 60 * 60)
+        # Longer than any request may take, a claim older than this is given up
+        app.config.setdefault('IDEMPOTENCY_LEASE', 60)
+        app.config.setdefault('IDEMPOTENCY_WAIT_TIMEOUT', 30)
+        app.extensions['idempotency'] = IdempotencyStore(
+            app.config['IDEMPOTENCY_DATABASE_URI'],
+            ttl=app.config['IDEMPOTENCY_TTL'],
+            lease=app.config['IDEMPOTENCY_LEASE']
+        )
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    @staticmethod
+    def get_store():
+        return current_app.extensions['idempotency']
+
+    def _before_request(self):
+        if request.method != 'POST':
+            return None
+        key = request.headers.get(self.header)
+        if not key:
+            return None
+
+        store = self.get_store()
+        store_key = (request.path, key)
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        deadline = time.monotonic() + current_app.config['IDEMPOTENCY_WAIT_TIMEOUT']
+
+        while True:
+            claim, owner = store.begin(store_key, fingerprint)
+            if owner:
+                g.idempotency = (store_key, claim)
+                return None
+
+            if claim != fingerprint:
+                return jsonify({'error': f'{self.header} was already used with a different request'}), 422
+
+            try:
+                stored = store.wait(store_key, max(deadline - time.monotonic(), 0))
+            except TimeoutError:
+                return jsonify({'error': f'A request with this {self.header} is still in progress'}), 409
+
+            if stored is not None:
+                break
+            # The first request failed and gave the key up, run this one instead
+
+        body, status, headers = stored
+        response = current_app.response_class(body, status=status, headers=headers)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def _after_request(self, response):
+        claim = g.pop('idempotency', None)
+        if claim is None:
+            return response
+
+        store_key, token = claim
+        if response.status_code >= 500 or response.is_streamed:
+            self.get_store().abandon(store_key, token)
+        else:
+            headers = [(k, v) for k, v in response.headers if k.lower() != 'content-length']
+            self.get_store().complete(store_key, token, (response.get_data(), response.status_code, headers))
+        return response
+
+    def _teardown_request(self, exc):
+        # Only reached with a claim left over when the view raised
+        claim = g.pop('idempotency', None)
+        if claim is not None:
+            self.get_store().abandon(*claim)
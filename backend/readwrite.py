@@ -0,0 +1,189 @@
+"""
+Read/write routing for SQLite.
+
+Writes go through each database's own engine, whose write transactions
+start with BEGIN IMMEDIATE (see `load_config` in app.py), so SQLite lets one
+writer in at a time and the others wait on its busy timeout. Views marked
+with `read_only` are served from a second pool of connections opened with
+`mode=ro` and `PRAGMA query_only`. In WAL mode those readers never wait on
+the writer and always see the last committed transaction.
+
+A read-only view also declares the most staleness it tolerates. A caller
+may opt into it with `Cache-Control: max-stale=<seconds>`, in which case
+the response can come from a per-process cache instead of the database.
+Without that header every request reads the database.
+"""
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_app_context, make_response, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+
+
+def enable_wal(engine):
+    """Switch a SQLite database to WAL mode. The setting is stored in the file."""
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+
+
+def _read_only_url(url):
+    """The `mode=ro` URL of an on-disk SQLite database, or None"""
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    if url.query.get('uri'):
+        return None  # Already a URI filename, leave its flags alone
+    return url.set(database=f'file:{url.database}', query={'mode': 'ro', 'uri': 'true'})
+
+
+def _query_only(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA query_only = ON')
+
+
+class ReadRouter:
+    """
+    Read-only engines, one per writer engine, created on first use.
+    Writer engines that can't have a read-only twin read through themselves.
+    """
+
+    def __init__(self, pool_size=4, engine_options=None):
+        self.pool_size = pool_size
+        self.engine_options = dict(engine_options or {})
+        self.responses = StaleResponseCache()
+        self._readers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app):
+        pool_size = app.config.get('READ_POOL_SIZE', 4)
+        if not pool_size:
+            return None
+        return cls(pool_size, app.config.get('SQLALCHEMY_ENGINE_OPTIONS'))
+
+    def reader_for(self, engine):
+        reader = self._readers.get(engine)
+        if reader is not None:
+            return reader
+        with self._lock:
+            if engine not in self._readers:
+                url = _read_only_url(engine.url)
+                if url is None:
+                    self._readers[engine] = engine
+                else:
+                    options = dict(self.engine_options, pool_size=self.pool_size, max_overflow=0)
+                    reader = create_engine(url, **options)
+                    event.listen(reader, 'connect', _query_only)
+                    self._readers[engine] = reader
+            return self._readers[engine]
+
+    def dispose(self):
+        for engine, reader in list(self._readers.items()):
+            if reader is not engine:
+                reader.dispose()
+
+
+def get_read_router():
+    return current_app.extensions.get('read_router') if has_app_context() else None
+
+
+def reading():
+    """True inside a view marked `read_only`"""
+    return has_app_context() and g.get('read_only', False)
+
+
+class ReadRoutingMixin:
+    """
+    Session mixin that sends the queries of read-only views to the read-only
+    twin of the engine they would otherwise use. Flushes always go to the
+    writer, so a read-only view that has to write once in a while still can.
+    """
+
+    def get_bind(self, *args, **kwargs):
+        engine = super().get_bind(*args, **kwargs)
+        if self._flushing or not reading():
+            return engine
+        router = get_read_router()
+        return router.reader_for(engine) if router else engine
+
+
+class ReadWriteSession(ReadRoutingMixin, Session):
+    """Flask-SQLAlchemy session with read routing, see `ReadRoutingMixin`"""
+
+
+class StaleResponseCache:
+    """Recent GET responses by full path, at most `max_entries` of them"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age):
+        with self._lock:
+            hit = self._entries.get(key)
+        if hit is not None and time.monotonic() - hit[0] <= max_age:
+            return hit
+        return None
+
+    def put(self, key, response):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= self.max_entries and key not in self._entries:
+                # Oldest first, dicts keep insertion order
+                for old in list(self._entries)[:max(self.max_entries // 10, 1)]:
+                    del self._entries[old]
+            self._entries.pop(key, None)
+            self._entries[key] = (now,) + response
+
+
+def accepted_staleness(max_staleness):
+    """Seconds of staleness this request accepts, capped by the view's bound"""
+    max_stale = request.cache_control.max_stale
+    if max_stale is None:
+        return 0
+    if max_stale == '*':
+        return max_staleness
+    return min(max_stale, max_staleness)
+
+
+def _serve(view, max_staleness, args, kwargs):
+    router = get_read_router()
+    staleness = accepted_staleness(max_staleness) if router else 0
+    if staleness <= 0:
+        return view(*args, **kwargs)
+
+    key = request.full_path
+    hit = router.responses.get(key, staleness)
+    if hit is not None:
+        stored_at, body, status, headers = hit
+        response = current_app.response_class(body, status=status, headers=headers)
+        response.headers['Age'] = str(int(time.monotonic() - stored_at))
+        return response
+
+    response = make_response(view(*args, **kwargs))
+    if response.status_code == 200:
+        headers = [(k, v) for k, v in response.headers if k.lower() != 'content-length']
+        router.responses.put(key, (response.get_data(), response.status_code, headers))
+    return response
+
+
+def read_only(max_staleness=0):
+    """
+    Mark a view as read-only so its queries use the read-only connections.
+    Callers can accept a cached response up to `max_staleness` seconds old.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.read_only = True
+            try:
+                return _serve(view, max_staleness, args, kwargs)
+            finally:
+                # The app context can outlive the request, e.g. under a test
+                # client inside `app.app_context()`, so later writes must not
+                # be routed to the read-only connections
+                g.read_only = False
+        return wrapper
+    return decorator
@@ -0,0 +1,546 @@
+"""
+Horizontal sharding of user data across several SQLite databases.
+
+Every sharded row belongs to one of `SLOT_COUNT` virtual slots, and a shard
+map file assigns slots to physical databases. Users are placed by a hash of
+their `telegram_id`; point cards and upgrades follow their user, escrows live
+on the sender's shard. Sharded rows get ids of the form
+`local_sequence * SLOT_COUNT + slot`, so any id (a `user_id`, a `sender_id`)
+tells which slot, and therefore which shard, holds the row.
+
+Cross-shard effects such as the referral bonus are written to a
+`shard_outbox` table in the same transaction as the change that caused them,
+and `deliver_outbox` applies them to the target shard, using `shard_inbox` to
+apply each message exactly once.
+
+Sharding is enabled by pointing the `SHARD_MAP` environment variable at a
+shard map file, see `split_database` and `move_slots` for creating one and
+for moving slots between shards while the service runs.
+"""
+import json
+import os
+import zlib
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, event, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.sql.visitors import iterate
+
+from readwrite import ReadRoutingMixin
+
+SLOT_COUNT = 1024
+
+# How a placement column maps to a slot
+HASH = 'hash'  # hash of a natural key, e.g. telegram_id
+ID = 'id'      # an id produced by this module, slot = id % SLOT_COUNT
+SLOT = 'slot'  # the column stores the slot itself
+
+# table name -> (placement column, kind, whether the table's own ids encode the slot)
+PLACEMENT = {
+    'user': ('telegram_id', HASH, True),
+    'point_card': ('user_id', ID, True),
+    'upgrade': ('user_id', ID, True),
+    'escrow': ('sender_id', ID, True),
+    'escrow_archive': ('sender_id', ID, True),
+    'shard_outbox': ('slot', SLOT, False),
+    'shard_inbox': ('target_id', ID, False),
+}
+
+# Tables whose rows are moved, keeping their id, into these other tables
+ARCHIVED_TO = {
+    'escrow': ('escrow_archive',),
+}
+
+# Per-shard id allocation, one row per sharded table
+_sequence_metadata = MetaData()
+shard_sequence = Table(
+    'shard_sequence', _sequence_metadata,
+    Column('name', String(50), primary_key=True),
+    Column('value', Integer, nullable=False)
+)
+
+# Slots this shard has handed over to another one, see `create_fences`
+moved_slot = Table(
+    'moved_slot', _sequence_metadata,
+    Column('slot', Integer, primary_key=True, autoincrement=False)
+)
+
+# Error raised by a write to a moved slot, see `is_fenced`
+FENCE_MESSAGE = 'slot moved to another shard'
+
+# Columns holding ids of rows that live in the same slot as the row itself
+_COLOCATED_ID_COLUMNS = {name: column for name, (column, kind, _) in PLACEMENT.items() if kind == ID}
+
+
+def slot_for_key(key):
+    """Slot of a natural key such as a telegram_id"""
+    return zlib.crc32(str(key).encode()) % SLOT_COUNT
+
+
+def slot_for_id(row_id):
+    return int(row_id) % SLOT_COUNT
+
+
+def slot_for_value(kind, value):
+    if kind == HASH:
+        return slot_for_key(value)
+    return slot_for_id(value)
+
+
+def slot_for_instance(instance):
+    column, kind, _ = PLACEMENT[instance.__table__.name]
+    return slot_for_value(kind, getattr(instance, column))
+
+
+def slot_for_row(table_name, row):
+    """Slot of a row given as a dict of column values"""
+    column, kind, _ = PLACEMENT[table_name]
+    return slot_for_value(kind, row[column])
+
+
+class ShardMap:
+    """Slot to shard assignment loaded from, and saved to, a JSON file"""
+
+    def __init__(self, shards, slots, version=1):
+        self.shards = dict(shards)  # shard id -> database URI
+        self.slots = list(slots)    # slot -> shard id
+        self.version = version
+
+    @classmethod
+    def even(cls, uris):
+        """Spread the slots evenly over `uris`, shard ids are '0', '1', ..."""
+        shards = {str(index): uri for index, uri in enumerate(uris)}
+        return cls(shards, [str(slot % len(uris)) for slot in range(SLOT_COUNT)])
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if len(data['slots']) != SLOT_COUNT:
+            raise ValueError(f"Shard map {path} must assign exactly {SLOT_COUNT} slots")
+        return cls(data['shards'], data['slots'], data.get('version', 1))
+
+    def save(self, path):
+        # Write-then-rename so running workers never read a half-written map
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.version, 'shards': self.shards, 'slots': self.slots}, f)
+        os.replace(tmp_path, path)
+
+    def shard_for_slot(self, slot):
+        return self.slots[slot]
+
+    def slots_on(self, shard_id):
+        return [slot for slot, owner in enumerate(self.slots) if owner == shard_id]
+
+
+class ShardRouter:
+    """
+    Routes ORM reads and writes to the shard that owns the rows involved.
+
+    The shard map file is re-read when it changes on disk, so slot moves made
+    by `move_slots` reach running workers on their next request.
+    """
+
+    def __init__(self, map_path, engine_options=None):
+        self.map_path = map_path
+        self.engine_options = engine_options or {}
+        self.engines = {}
+        self._mtime = None
+        self.shard_map = None
+        self.refresh()
+
+    @classmethod
+    def from_config(cls, app):
+        map_path = app.config.get('SHARD_MAP')
+        if not map_path:
+            return None
+        return cls(map_path, app.config.get('SQLALCHEMY_ENGINE_OPTIONS'))
+
+    def refresh(self):
+        mtime = os.stat(self.map_path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        self.shard_map = ShardMap.load(self.map_path)
+        for shard_id, uri in self.shard_map.shards.items():
+            if shard_id not in self.engines:
+                self.engines[shard_id] = create_engine(uri, **self.engine_options)
+        self._mtime = mtime
+
+    def init_db(self, db):
+        """
+        Hook the router into a Flask-SQLAlchemy extension. Its session is
+        rebuilt with `session_options()`, so one process serves one sharded
+        app, which is how the app factory is used.
+        """
+        db.session = db._make_scoped_session(self.session_options())
+        if not event.contains(db.Model, 'before_insert', self._assign_id):
+            event.listen(db.Model, 'before_insert', self._assign_id, propagate=True)
+
+    def session_options(self):
+        return {'class_': RoutedSession, 'router': self}
+
+    @property
+    def shard_ids(self):
+        return list(self.shard_map.shards)
+
+    def shard_for_slot(self, slot):
+        return self.shard_map.shard_for_slot(slot)
+
+    def shard_for_key(self, key):
+        return self.shard_for_slot(slot_for_key(key))
+
+    def create_all(self, metadata):
+        for engine in self.engines.values():
+            metadata.create_all(engine)
+            _sequence_metadata.create_all(engine)
+            create_fences(engine, metadata)
+
+    # ShardedSession callbacks
+
+    def shard_chooser(self, mapper, instance, clause=None, **kw):
+        if instance is not None and mapper.local_table.name in PLACEMENT:
+            return self.shard_for_slot(slot_for_instance(instance))
+        # Statements that are not tied to a sharded row run on the first shard
+        return self.shard_ids[0]
+
+    def identity_chooser(self, mapper, primary_key, **kw):
+        table = mapper.local_table.name
+        if table in PLACEMENT and PLACEMENT[table][2]:
+            return [self.shard_for_slot(slot_for_id(primary_key[0]))]
+        return self.shard_ids
+
+    def execute_chooser(self, context):
+        shards = _shards_for_statement(self, context.statement, context.parameters)
+        return shards if shards else self.shard_ids
+
+    def _assign_id(self, mapper, connection, target):
+        table = mapper.local_table
+        if table.name not in PLACEMENT or not PLACEMENT[table.name][2] or target.id is not None:
+            return
+        # Bumping the sequence takes the shard's write lock first, so
+        # concurrent writers can't be handed the same value. The sequence
+        # also stays above ids copied in by split_database or move_slots,
+        # including those of rows since moved to the table's archive.
+        connection.execute(
+            shard_sequence.insert().prefix_with('OR IGNORE').values(name=table.name, value=0)
+        )
+        floor = ', '.join(
+            f'(SELECT coalesce(max(id), 0) FROM "{name}")'
+            for name in (table.name,) + ARCHIVED_TO.get(table.name, ())
+        )
+        connection.execute(text(
+            f'UPDATE shard_sequence SET value = max(value + 1, max({floor}, 0) / {SLOT_COUNT} + 1) '
+            f'WHERE name = :name'
+        ), {'name': table.name})
+        sequence = connection.scalar(select(shard_sequence.c.value).where(shard_sequence.c.name == table.name))
+        target.id = sequence * SLOT_COUNT + slot_for_instance(target)
+
+
+class RoutedSession(ReadRoutingMixin, ShardedSession):
+    """ShardedSession that can be used as a Flask-SQLAlchemy session class"""
+
+    def __init__(self, db, router, **kwargs):
+        self._db = db
+        self.router = router
+        super().__init__(
+            shard_chooser=router.shard_chooser,
+            identity_chooser=router.identity_chooser,
+            execute_chooser=router.execute_chooser,
+            shards=router.engines,
+            **kwargs
+        )
+
+
+def _bind_values(bind, parameters):
+    if parameters and not isinstance(parameters, list) and bind.key in parameters:
+        value = parameters[bind.key]
+    elif bind.callable is not None:
+        value = bind.callable()
+    else:
+        value = bind.value
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def _shards_for_statement(router, statement, parameters):
+    """
+    Work out which shards a statement must run on from equality and IN
+    comparisons against placement columns. Returns None when the statement
+    cannot be narrowed down and has to run everywhere.
+    """
+    where = getattr(statement, 'whereclause', None)
+    if where is None:
+        return None
+
+    narrowed = None
+    for element in iterate(where):
+        if isinstance(element, BooleanClauseList) and element.operator is operators.or_:
+            return None
+        if not isinstance(element, BinaryExpression):
+            continue
+        if element.operator not in (operators.eq, operators.in_op):
+            continue
+        column, bind = element.left, element.right
+        if not isinstance(column, Column) or not isinstance(bind, BindParameter):
+            continue
+        kind = _placement_kind(column)
+        if kind is None:
+            continue
+
+        try:
+            shards = {
+                router.shard_for_slot(slot_for_value(kind, value))
+                for value in _bind_values(bind, parameters) if value is not None
+            }
+        except (TypeError, ValueError):
+            # Not an id, e.g. unchecked user input. It matches nothing, but
+            # let every shard say so rather than fail the statement here.
+            return None
+        narrowed = shards if narrowed is None else narrowed & shards
+
+    return sorted(narrowed) if narrowed else None
+
+
+def _placement_kind(column):
+    table = getattr(column.table, 'name', None)
+    if table not in PLACEMENT:
+        return None
+    placement_column, kind, encodes_ids = PLACEMENT[table]
+    if column.name == placement_column:
+        return kind
+    if column.name == 'id' and encodes_ids:
+        return ID
+    return None
+
+
+# Outbox relay
+
+def deliver_message(db, inbox_model, handlers, message):
+    """
+    Apply one outbox message on its target shard and mark it delivered.
+
+    `handlers` maps a message kind to a callable `(session, message)` that
+    applies it. The message is applied and recorded in the inbox in one
+    transaction on the target shard, then marked delivered on its source
+    shard, so a crash in between only causes a redelivery the inbox ignores.
+    Of two deliverers racing for the same message, the one whose inbox row
+    loses on the unique message_id rolls back its effect.
+    """
+    seen = inbox_model.query.filter_by(message_id=message.message_id, target_id=message.target_id).first()
+    if not seen:
+        handlers[message.kind](db.session, message)
+        db.session.add(inbox_model(message_id=message.message_id, target_id=message.target_id))
+        try:
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            if is_fenced(error):
+                raise
+
+    message.delivered_time = datetime.utcnow()
+    db.session.commit()
+
+
+def deliver_outbox(db, outbox_model, inbox_model, handlers, shard_options, limit=100):
+    """
+    Deliver up to `limit` pending outbox messages from each shard with
+    `deliver_message`. Returns the number of messages delivered.
+    """
+    delivered = 0
+    for options in shard_options:
+        pending = outbox_model.query.execution_options(**options).filter(
+            outbox_model.delivered_time.is_(None)
+        ).order_by(outbox_model.id).limit(limit).all()
+
+        for message in pending:
+            deliver_message(db, inbox_model, handlers, message)
+            delivered += 1
+    return delivered
+
+
+def purge_outbox(engines, outbox_table, inbox_table, before):
+    """
+    Delete outbox messages delivered before `before`, and inbox entries
+    received before it. An inbox entry only guards against redelivery of a
+    message that was applied but not yet marked delivered, so `before` must
+    be further back than the relay ever lags. Returns the number of outbox
+    messages deleted.
+    """
+    purged = 0
+    for engine in engines:
+        with engine.begin() as conn:
+            purged += conn.execute(outbox_table.delete().where(outbox_table.c.delivered_time < before)).rowcount
+            conn.execute(inbox_table.delete().where(inbox_table.c.received_time < before))
+    return purged
+
+
+# Offline split and online slot moves
+
+def _slot_filter(table, slot):
+    column, kind, _ = PLACEMENT[table.name]
+    if kind == SLOT:
+        return table.c[column] == slot
+    if kind == ID:
+        return table.c[column] % SLOT_COUNT == slot
+    # Hash placed rows carry their slot in their own id
+    return table.c.id % SLOT_COUNT == slot
+
+
+def _slot_expression(table_name, row):
+    """SQL for the slot of `row` (NEW or OLD in a trigger), like `_slot_filter`"""
+    column, kind, _ = PLACEMENT[table_name]
+    if kind == SLOT:
+        return f'{row}.{column}'
+    if kind == ID:
+        return f'{row}.{column} % {SLOT_COUNT}'
+    return f'{row}.id % {SLOT_COUNT}'
+
+
+def create_fences(engine, metadata):
+    """
+    Make a shard reject writes to the slots it has moved away.
+
+    Each sharded table gets triggers that abort an insert, update or delete
+    of a row whose slot is listed in `moved_slot`. They run inside the
+    writer's own transaction, so a worker still routing by an old shard map
+    can't write to a slot after `move_slots` has taken it, however long its
+    request was in flight or waiting for the write lock.
+    """
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in PLACEMENT:
+                continue
+            for event_name, row in (('INSERT', 'NEW'), ('UPDATE', 'OLD'), ('DELETE', 'OLD')):
+                conn.exec_driver_sql(
+                    f'CREATE TRIGGER IF NOT EXISTS "fence_{table.name}_{event_name.lower()}" '
+                    f'BEFORE {event_name} ON "{table.name}" '
+                    f'WHEN EXISTS (SELECT 1 FROM moved_slot WHERE slot = {_slot_expression(table.name, row)}) '
+                    f"BEGIN SELECT RAISE(ABORT, '{FENCE_MESSAGE}'); END"
+                )
+
+
+def is_fenced(error):
+    """True when a database error is a write rejected by `create_fences`"""
+    return FENCE_MESSAGE in str(getattr(error, 'orig', error))
+
+
+def move_slots(map_path, metadata, slots, target_shard, engine_options=None):
+    """
+    Move `slots` to `target_shard` one slot at a time.
+
+    For each slot the source shard is write-locked (BEGIN IMMEDIATE), the
+    slot's rows are copied to the target, the map file is rewritten, and
+    the rows are deleted from the source and the slot fenced off there
+    (see `create_fences`) before the lock is released. Writers to the
+    source shard wait for at most one slot's worth of copying; readers are
+    never blocked under WAL. A write that still reaches the source for a
+    moved slot fails, and the app answers it with 503 so the client retries
+    against the new map.
+    """
+    shard_map = ShardMap.load(map_path)
+    if target_shard not in shard_map.shards:
+        raise ValueError(f"Unknown shard {target_shard!r}")
+    engines = {shard_id: create_engine(uri, **(engine_options or {}))
+               for shard_id, uri in shard_map.shards.items()}
+    metadata.create_all(engines[target_shard])
+    for engine in engines.values():
+        _sequence_metadata.create_all(engine)
+        create_fences(engine, metadata)
+    tables = [table for table in metadata.sorted_tables if table.name in PLACEMENT]
+
+    moved = 0
+    for slot in slots:
+        source_shard = shard_map.slots[slot]
+        if source_shard == target_shard:
+            continue
+
+        with engines[source_shard].connect() as src:
+            src.exec_driver_sql('BEGIN IMMEDIATE')
+            with engines[target_shard].begin() as dst:
+                # The slot may be coming back to a shard it was moved off before
+                dst.execute(moved_slot.delete().where(moved_slot.c.slot == slot))
+                for table in tables:
+                    rows = src.execute(table.select().where(_slot_filter(table, slot))).mappings().all()
+                    if rows:
+                        dst.execute(table.insert().prefix_with('OR REPLACE'), [dict(row) for row in rows])
+
+            shard_map.slots[slot] = target_shard
+            shard_map.version += 1
+            shard_map.save(map_path)
+
+            for table in reversed(tables):
+                src.execute(table.delete().where(_slot_filter(table, slot)))
+            src.execute(moved_slot.insert().prefix_with('OR IGNORE').values(slot=slot))
+            src.commit()
+        moved += 1
+    return moved
+
+
+def split_database(source_uri, metadata, shard_uris, map_path, batch_size=1000):
+    """
+    Split an unsharded database into `shard_uris` and write a shard map.
+
+    Rows are streamed from the source in batches and re-keyed so their ids
+    carry their slot; every id reference is rewritten to match. Run it with
+    the service stopped and the outbox drained.
+    """
+    shard_map = ShardMap.even(shard_uris)
+    source = create_engine(source_uri)
+    engines = {shard_id: create_engine(uri) for shard_id, uri in shard_map.shards.items()}
+    for engine in engines.values():
+        metadata.create_all(engine)
+        _sequence_metadata.create_all(engine)
+        create_fences(engine, metadata)
+
+    tables = metadata.tables
+    user_ids = {}  # old user id -> new user id
+
+    def new_id(old_id, slot):
+        return old_id * SLOT_COUNT + slot
+
+    def stream(conn, table):
+        result = conn.execution_options(yield_per=batch_size).execute(
+            select(table).order_by(table.c.id)
+        ).mappings()
+        for partition in result.partitions():
+            yield [dict(row) for row in partition]
+
+    with source.connect() as src:
+        for batch in stream(src, tables['user']):
+            for row in batch:
+                user_ids[row['id']] = new_id(row['id'], slot_for_key(row['telegram_id']))
+
+        def remap_users(row):
+            for column in ('referrer_id', 'user_id', 'sender_id', 'receiver_id', 'requested_by'):
+                if row.get(column) is not None:
+                    row[column] = user_ids.get(row[column], row[column])
+            return row
+
+        connections = {shard_id: engine.connect() for shard_id, engine in engines.items()}
+        try:
+            for name in ('user', 'point_card', 'upgrade', 'escrow', 'escrow_archive'):
+                if name not in tables:
+                    continue
+                table = tables[name]
+                for batch in stream(src, table):
+                    by_shard = {}
+                    for row in batch:
+                        row = remap_users(row)
+                        if name == 'user':
+                            row['id'] = user_ids[row['id']]
+                        else:
+                            row['id'] = new_id(row['id'], slot_for_id(row[_COLOCATED_ID_COLUMNS[name]]))
+                        by_shard.setdefault(shard_map.shard_for_slot(slot_for_id(row['id'])), []).append(row)
+                    for shard_id, rows in by_shard.items():
+                        connections[shard_id].execute(table.insert(), rows)
+            for conn in connections.values():
+                conn.commit()
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    shard_map.save(map_path)
+    return shard_map
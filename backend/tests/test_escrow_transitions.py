@@ -0,0 +1,249 @@
+"""
+Contention tests for the escrow transitions in escrow_states.
+
+Racers are separate processes, as gunicorn workers are, each with its own
+app and database connection. They start together behind a barrier and walk
+the same escrows in different orders, so every escrow is contended.
+
+The app is only ever built in spawned processes: a sharded app replaces the
+module-level `db.session`, so sharded and unsharded apps can't share one.
+
+Run from the backend directory:
+
+    python -m pytest tests
+"""
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+import sqlalchemy
+
+SENDER_IDS = (1024, 1025)  # slots 0 and 1, one per shard of an even two-shard map
+RECEIVER_ID = 7
+
+
+def _load_app(config):
+    import logging
+    logging.disable(logging.WARNING)
+    import app as backend
+    return backend, backend.create_app(config)
+
+
+def _in_process(function, *args):
+    """Run `function` in a fresh spawned process and return its result"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(function, *args).result()
+
+
+def _create_schema(config, shard_uris):
+    if shard_uris:
+        import sharding
+        sharding.ShardMap.even(shard_uris).save(config['SHARD_MAP'])
+    backend, application = _load_app(config)
+    with application.app_context():
+        backend.create_schema()
+
+
+def _seed(config, escrows):
+    backend, application = _load_app(config)
+    now = datetime.utcnow()
+    with application.app_context():
+        for escrow in escrows:
+            backend.db.session.add(backend.Escrow(
+                escrow_id=escrow['escrow_id'],
+                sender_id=escrow['sender_id'],
+                sender_wallet_address='EQ',
+                receiver_id=RECEIVER_ID,
+                receiver_wallet_address='EQ',
+                amount=1.0,
+                fee_amount=0.1,
+                status=escrow['status'],
+                cancel_status=escrow.get('cancel_status'),
+                creation_time=now,
+                lock_period=1,
+                unlock_time=now + timedelta(days=escrow.get('unlock_in_days', 1)),
+                pin_hash='x'
+            ))
+        backend.db.session.commit()
+
+
+def _statuses(config, escrow_ids):
+    backend, application = _load_app(config)
+    with application.app_context():
+        escrows = backend.Escrow.query.filter(backend.Escrow.escrow_id.in_(escrow_ids)).all()
+        return {escrow.escrow_id: (escrow.status, escrow.cancel_status) for escrow in escrows}
+
+
+def _race(config, moves, seed, barrier):
+    """
+    Apply each `(transition, escrow_id, args)` of `moves` in a shuffled
+    order, committing after each one. Returns the moves that won.
+    """
+    from sqlalchemy.exc import OperationalError
+    backend, application = _load_app(config)
+    moves = list(moves)
+    random.Random(seed).shuffle(moves)
+    won = []
+    with application.app_context():
+        transitions = backend.escrow_transitions
+        barrier.wait()
+        for name, escrow_id, args in moves:
+            while True:
+                try:
+                    changed = getattr(transitions, name)(backend.db.session, escrow_id, *args)
+                    backend.db.session.commit()
+                    break
+                except OperationalError:
+                    # SQLite "database is locked", try the same transition again
+                    backend.db.session.rollback()
+            if changed:
+                won.append((name, escrow_id))
+    return won
+
+
+def _run_race(config, racers):
+    """Run one process per entry of `racers`, a list of moves, and merge their wins"""
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Manager() as manager, ProcessPoolExecutor(max_workers=len(racers), mp_context=ctx) as pool:
+        barrier = manager.Barrier(len(racers))
+        futures = [pool.submit(_race, config, moves, seed, barrier) for seed, moves in enumerate(racers)]
+        return [win for future in futures for win in future.result()]
+
+
+def _bulk(config, batch_size, steps):
+    """Run each `(transition, escrow_ids)` of `steps` and return their rowcounts"""
+    import escrow_states
+    escrow_states.BULK_BATCH_SIZE = batch_size
+    backend, application = _load_app(config)
+    rowcounts = []
+    with application.app_context():
+        for name, escrow_ids in steps:
+            rowcounts.append(getattr(backend.escrow_transitions, name)(backend.db.session, escrow_ids))
+            backend.db.session.commit()
+    return rowcounts
+
+
+def _make_database(tmp_path, sharded):
+    config = {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'app.db'}",
+        'SHARD_MAP': None
+    }
+    shard_uris = None
+    if sharded:
+        config['SHARD_MAP'] = str(tmp_path / 'shards.json')
+        shard_uris = [f"sqlite:///{tmp_path / f'shard{index}.db'}" for index in range(2)]
+    _in_process(_create_schema, config, shard_uris)
+    return config
+
+
+@pytest.fixture(params=['single', 'sharded'])
+def database(request, tmp_path):
+    return _make_database(tmp_path, request.param == 'sharded')
+
+
+@pytest.fixture
+def sharded_database(tmp_path):
+    return _make_database(tmp_path, True)
+
+
+def _escrows(prefix, count, **fields):
+    return [dict(fields, escrow_id=f'{prefix}-{i}', sender_id=SENDER_IDS[i % 2]) for i in range(count)]
+
+
+def _wins_per_escrow(wins, escrows):
+    counts = {escrow['escrow_id']: 0 for escrow in escrows}
+    for _, escrow_id in wins:
+        counts[escrow_id] += 1
+    return counts
+
+
+def test_release_races_request_cancel(database):
+    escrows = _escrows('cancel', 100, status='active')
+    _in_process(_seed, database, escrows)
+
+    releases = [('release', e['escrow_id'], (e['sender_id'],)) for e in escrows]
+    cancels = [('request_cancel', e['escrow_id'], (RECEIVER_ID,)) for e in escrows]
+    wins = _run_race(database, [releases, cancels, releases, cancels])
+
+    assert set(_wins_per_escrow(wins, escrows).values()) == {1}
+    statuses = _in_process(_statuses, database, [e['escrow_id'] for e in escrows])
+    for name, escrow_id in wins:
+        if name == 'release':
+            assert statuses[escrow_id] == ('completed', None)
+        else:
+            assert statuses[escrow_id] == ('pending_cancel', 'receiver_requested')
+
+
+def test_release_races_withdraw(database):
+    escrows = _escrows('withdraw', 100, status='active', unlock_in_days=-1)
+    _in_process(_seed, database, escrows)
+
+    now = datetime.utcnow()
+    releases = [('release', e['escrow_id'], (e['sender_id'],)) for e in escrows]
+    withdrawals = [('withdraw', e['escrow_id'], (RECEIVER_ID, now)) for e in escrows]
+    wins = _run_race(database, [releases, withdrawals, releases, withdrawals])
+
+    assert set(_wins_per_escrow(wins, escrows).values()) == {1}
+    statuses = _in_process(_statuses, database, [e['escrow_id'] for e in escrows])
+    assert set(statuses.values()) == {('completed', None)}
+
+
+def test_release_races_confirm_cancel(database):
+    escrows = _escrows('confirm', 100, status='pending_cancel', cancel_status='sender_requested')
+    _in_process(_seed, database, escrows)
+
+    releases = [('release', e['escrow_id'], (e['sender_id'],)) for e in escrows]
+    confirmations = [('confirm_cancel', e['escrow_id'], (RECEIVER_ID,)) for e in escrows]
+    wins = _run_race(database, [releases, confirmations, confirmations])
+
+    # A pending cancellation can't be released, and is confirmed only once
+    assert set(_wins_per_escrow(wins, escrows).values()) == {1}
+    assert {name for name, _ in wins} == {'confirm_cancel'}
+    statuses = _in_process(_statuses, database, [e['escrow_id'] for e in escrows])
+    assert set(statuses.values()) == {('cancelled', 'mutual')}
+
+
+@pytest.mark.parametrize('batch_size', [10000, 3])
+def test_bulk_transition_rowcounts(database, batch_size):
+    active = _escrows('active', 10, status='active')
+    pending = _escrows('pending', 6, status='pending_cancel', cancel_status='sender_requested')
+    finished = _escrows('completed', 4, status='completed') + _escrows('cancelled', 4, status='cancelled')
+    _in_process(_seed, database, active + pending + finished)
+
+    first_active = [e['escrow_id'] for e in active[:5]]
+    everything = [e['escrow_id'] for e in active + pending + finished] + ['missing']
+    rowcounts = _in_process(_bulk, database, batch_size, [
+        # Only active escrows are released, finished and pending ones are left alone
+        ('release_many', first_active + [e['escrow_id'] for e in pending + finished]),
+        ('release_many', first_active),
+        # The other five active escrows and every pending one
+        ('cancel_many', everything),
+        ('cancel_many', everything)
+    ])
+    assert rowcounts == [5, 0, 11, 0]
+
+    statuses = _in_process(_statuses, database, everything)
+    assert [statuses[escrow_id] for escrow_id in first_active] == [('completed', None)] * 5
+    assert [statuses[e['escrow_id']] for e in active[5:] + pending] == [('cancelled', 'admin')] * 11
+    assert [statuses[e['escrow_id']][0] for e in finished] == ['completed'] * 4 + ['cancelled'] * 4
+
+
+def test_bulk_rowcount_is_merged_across_shards(sharded_database, tmp_path):
+    escrows = _escrows('spread', 8, status='active')
+    _in_process(_seed, sharded_database, escrows)
+
+    # The escrows really are split over both shards
+    for index in range(2):
+        engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / f'shard{index}.db'}")
+        with engine.connect() as conn:
+            assert conn.exec_driver_sql('SELECT count(*) FROM escrow').scalar() == 4
+        engine.dispose()
+
+    escrow_ids = [e['escrow_id'] for e in escrows]
+    assert _in_process(_bulk, sharded_database, 10000, [
+        ('release_many', escrow_ids[:6]),
+        ('cancel_many', escrow_ids),
+        ('release_many', escrow_ids)
+    ]) == [6, 2, 0]
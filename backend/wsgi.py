@@ -0,0 +1,11 @@
+"""
+WSGI entry point for gunicorn, see gunicorn.conf.py.
+
+With `preload_app` this module is imported once in the gunicorn master, so
+the app is built and warmed up there and every forked worker starts with
+it already in memory. Create the schema beforehand with `flask init-db`.
+"""
+from app import create_app, warm_up
+
+app = create_app()
+warm_up(app)